@@ -0,0 +1,145 @@
+from pathlib import Path
+import xml.etree.ElementTree as et
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import platform
+import time
+import tracemalloc
+
+import ruleout_export
+import synthetic_mint
+
+# the write stage includes the conversion to the data types of the label schema, done per row
+# for csv and xlsx and per batch of rows with pandas for parquet and arrow, as in the export
+STAGES = ['parse', 'getAllCases', 'get_covid_assessment', 'write']
+
+# stages when the cases are streamed, the results of the cases are not kept in memory, so each
+# stage runs the export up to a later step again: splitting or parsing the cases only, parsing
+# and anonymizing them, and the whole export as run by ruleout_export.py
+STREAM_STAGES = ['parse', 'parse + get_covid_assessment', 'export']
+
+# whether the benchmark runs the streaming code paths of the export instead of the whole tree
+def streaming(args):
+    return args.stream or args.parser != 'etree' or args.workers > 1
+
+# run all stages of the export on a single input file, returns the wall time and, if memory
+# tracing is enabled, the peak of the memory allocated in each stage
+def run_stages(xml_file, out_file, args, trace_memory=False):
+    export_args = ruleout_export.get_arg_parser().parse_args(['-i', str(xml_file), '-o', str(out_file), '-p', args.parser, '-w', str(args.workers)] + (['-s'] if args.stream else []))
+    export_args.case_filter = ruleout_export.CaseFilter.from_args(export_args)
+    label_schema = ruleout_export.load_label_schema(export_args.schema)
+    results = {}
+
+    @contextlib.contextmanager
+    def stage(name):
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        yield
+        results[name] = {'seconds': time.perf_counter() - start}
+        if trace_memory:
+            results[name]['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+
+    # the export prints errors of single cases, which are not of interest here
+    with contextlib.redirect_stdout(io.StringIO()):
+        if streaming(args):
+            with stage('parse'):
+                for case in ruleout_export.load_cases(xml_file, export_args):
+                    pass
+            with stage('parse + get_covid_assessment'):
+                for case_assessment in ruleout_export.process_cases(ruleout_export.load_cases(xml_file, export_args), export_args):
+                    pass
+            num_cases = 0
+            with stage('export'):
+                with ruleout_export.open_writer(out_file, args.format, label_schema) as writer:
+                    for case_assessment in ruleout_export.process_cases(ruleout_export.load_cases(xml_file, export_args), export_args):
+                        if case_assessment is not None:
+                            writer.write(case_assessment)
+                            num_cases += 1
+            results['cases'] = num_cases
+            return results
+
+        with stage('parse'):
+            root = et.parse(xml_file).getroot()
+        with stage('getAllCases'):
+            cases = ruleout_export.getAllCases(root)
+        with stage('get_covid_assessment'):
+            case_assessments = [case_assessment for case_assessment in ruleout_export.process_cases(cases, export_args) if case_assessment is not None]
+        del root, cases
+        with stage('write'):
+            with ruleout_export.open_writer(out_file, args.format, label_schema) as writer:
+                for case_assessment in case_assessments:
+                    writer.write(case_assessment)
+    results['cases'] = len(case_assessments)
+    return results
+
+# run the benchmark for all requested sizes, synthetic exports are generated once and reused
+def main(args):
+    work_dir = Path(args.work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'format': args.format,
+        'parser': args.parser,
+        'stream': streaming(args),
+        'workers': args.workers,
+        'seed': args.seed,
+        'runs': [],
+    }
+
+    for num_cases in args.cases:
+        xml_file = work_dir / f"synthetic_{num_cases}_{args.seed}.xml"
+        if not xml_file.exists():
+            print(f"Generating {num_cases} synthetic cases: {xml_file}")
+            generator_args = argparse.Namespace(seed=args.seed, schema=None, trials=1, arms=2, sites=10, fill_rate=0.6, noise_labels=20)
+            synthetic_mint.generate(xml_file, num_cases, generator_args)
+        out_file = work_dir / f"synthetic_{num_cases}.{args.format}"
+
+        # wall times are taken as the best of all repetitions without memory tracing,
+        # the memory is measured in a separate run because tracing slows down all stages
+        print(f"Benchmarking {num_cases} cases ({xml_file.stat().st_size / 2**20:.1f} MB)")
+        timings = [run_stages(xml_file, out_file, args) for _ in range(args.repeat)]
+        memory = run_stages(xml_file, out_file, args, trace_memory=True) if args.memory else None
+
+        run = {'cases': num_cases, 'file_mb': xml_file.stat().st_size / 2**20, 'stages': {}}
+        for name in STREAM_STAGES if streaming(args) else STAGES:
+            seconds = min(timing[name]['seconds'] for timing in timings)
+            run['stages'][name] = {'seconds': seconds, 'cases_per_second': num_cases / seconds if seconds > 0 else None}
+            if memory is not None:
+                run['stages'][name]['peak_mb'] = memory[name]['peak_mb']
+            peak = f", peak {memory[name]['peak_mb']:9.1f} MB" if memory is not None else ''
+            print(f"  {name:<30}{seconds:9.3f} s{peak}")
+        report['runs'].append(run)
+
+    # results are appended to a history file, one line per benchmark, to track them over time
+    if args.history is not None:
+        with open(args.history, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(report) + '\n')
+        print(f"Appended results to {args.history}")
+    return report
+
+# program entry point
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the RACOON Ruleout export on synthetic Mint XML exports")
+    parser.add_argument("-n", "--cases", help="Number of cases, can be given several times", type=int, action="append")
+    parser.add_argument("-d", "--work-dir", help="Directory for the synthetic exports and output files", default="benchmark_data")
+    parser.add_argument("-f", "--format", help="Output format of the write stage", choices=ruleout_export.OUTPUT_FORMATS.keys(), default='xlsx')
+    parser.add_argument("-r", "--repeat", help="Number of timed repetitions, the fastest one is reported", type=int, default=1)
+    parser.add_argument("--no-memory", help="Skip the memory profiling run", dest="memory", action="store_false")
+    parser.add_argument("--history", help="JSON lines file the results are appended to", default="benchmark_history.jsonl")
+    parser.add_argument("--seed", help="Random seed of the synthetic exports", type=int, default=0)
+    parser.add_argument("-s", "--stream", help="Benchmark the streaming export instead of loading the whole XML tree", action="store_true")
+    parser.add_argument("-p", "--parser", help="XML parser of the export, expat and lxml always stream", choices=['etree', 'expat', 'lxml'], default='etree')
+    parser.add_argument("-w", "--workers", help="Number of worker processes of the export, always streams; the memory of the workers is not traced", type=int, default=1)
+
+    args = parser.parse_args()
+    if args.cases is None:
+        args.cases = [1000, 10000]
+
+    main(args)
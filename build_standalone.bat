@@ -1 +1 @@
-pyinstaller.exe .\ruleout_export.py --onefile
\ No newline at end of file
+pyinstaller.exe .\ruleout_export.py --onefile --add-data "ruleout_labels.json;."
\ No newline at end of file
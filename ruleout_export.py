@@ -1,268 +1,1371 @@
 import xml.etree.ElementTree as et
+from xml.parsers import expat
 from pathlib import Path
-import pandas as pd
 import hashlib
 import argparse
-import openpyxl
 import uuid
+import multiprocessing
+import functools
+import json
+import sqlite3
+import glob
+import math
+import time
+import contextlib
+import platform
+import gzip
+import zipfile
+import mmap
+import queue
+import threading
+import itertools
+import heapq
+import pickle
+import shutil
+import tempfile
+import csv
+import re
+import codecs
+import os
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, Counter
 
-# main program
+# label schema mapping each label exported for the Ruleout training to its data type
+LABEL_SCHEMA_FILE = Path(__file__).parent / 'ruleout_labels.json'
+LABEL_DTYPES = ['category', 'int', 'float', 'bool', 'string']
+INPUT_PATTERNS = ['*.xml', '*.xml.gz', '*.xml.zst', '*.xml.zstd', '*.zip']
+AGE_LABEL = 'racoon-covid-19-demographic-information-age2'
+
+# main program, the run is instrumented and its report written when the run exits
 def main(args):
-    xml_file = Path(args.input)
+    global MAX_MESSAGES
+    MAX_MESSAGES = args.max_messages
+    EVENTS.clear() # events are counted per run, the watch mode runs several exports in one process
+    _printed_messages.clear()
+    args.run_report = RunReport(args)
+    status = 'failed'
+    try:
+        export(args)
+        status = 'finished'
+    finally:
+        args.run_report.finish(status, args.report)
+
+# export all cases of the input file(s) to the output file
+def export(args):
+    run_report = args.run_report
+    xml_files = resolve_inputs(args.input)
+    label_schema = load_label_schema(args.schema)
+    index = None
+    chunked_export = None
+    extra_columns = []
+    append = False
+    catalog = LabelCatalog(args.catalog_top_k) if args.catalog else None
+    args.case_filter = CaseFilter.from_args(args)
+
+    if len(xml_files) > 1:
+        # batch mode, the input files are parsed concurrently and merged into one output
+        print(f"Found {len(xml_files)} input files")
+        case_assessments = process_files(xml_files, args, catalog)
+        extra_columns = ['source']
+        print(f"Parsing, anonymizing and writing cases to output file: {args.output}")
+        stage = 'extract and write'
+    else:
+        with run_report.stage('load'):
+            cases = load_cases(xml_files[0], args)
+        if args.incremental:
+            # only new or modified cases are parsed; the output of the previous run is kept if no case
+            # changed, extended if cases were only added at its end, otherwise written from the case index
+            print(f"Updating case index {args.incremental}")
+            with run_report.stage('update index'):
+                index = CaseIndex(args.incremental, label_schema, args.case_filter)
+                update_case_index(index, cases, args, catalog)
+            output_mode = index.output_mode(args.output, output_format(args.output, args.format))
+            if output_mode == 'unchanged':
+                print(f"Output file is up to date: {args.output}")
+                case_assessments = None
+            elif output_mode == 'append':
+                print(f"Appending new cases to output file: {args.output}")
+                case_assessments = index.added_rows()
+                append = True
+            else:
+                print(f"Writing output file: {args.output}")
+                case_assessments = index.rows()
+            stage = 'write'
+        elif args.chunk_size:
+            # cases are written to shards of chunk_size cases first, a failed run can be resumed
+            chunked_export = ChunkedExport(args.output, xml_files[0], args, label_schema)
+            with run_report.stage('extract'):
+                catalog = chunked_export.run(cases, args, catalog)
+            case_assessments = chunked_export.rows()
+            print(f"Writing output file: {args.output}")
+            stage = 'write'
+        else:
+            # cases are written one row per case as soon as they have been parsed
+            case_assessments = process_cases(cases, args, catalog)
+            print(f"Parsing, anonymizing and writing cases to output file: {args.output}")
+            stage = 'extract and write'
+
+    # failed and excluded cases are returned as None
+    with run_report.stage(stage):
+        if case_assessments is not None:
+            with open_writer(args.output, args.format, label_schema, extra_columns, append) as writer:
+                for case_assessment in case_assessments:
+                    if case_assessment is None:
+                        continue
+                    writer.write(case_assessment)
+                    run_report.counters['written_cases'] += 1
+    print(f"Wrote {run_report.counters['written_cases']} cases")
+    run_report.counters['excluded_cases'] = sum(args.case_filter.hits.values())
+    run_report.filter_hits = dict(args.case_filter.hits)
+    args.case_filter.report()
+    if index is not None:
+        index.record_output(args.output, output_format(args.output, args.format))
+        index.close()
+    if chunked_export is not None:
+        chunked_export.cleanup()
+
+    if catalog is not None:
+        print(f"Writing label catalog: {args.catalog}")
+        with run_report.stage('catalog'):
+            catalog.save(args.catalog)
+
+# list of input files, the input can be a single file, a directory or a glob pattern; existing
+# paths are never taken for a pattern, so file names such as "site [1].xml" work as well
+def resolve_inputs(input) -> list:
+    if isinstance(input, str) and not input.strip():
+        raise FileNotFoundError("No input file given")
+    input_path = Path(input)
+    if input_path.is_dir():
+        xml_files = list_inputs(input_path)
+    elif input_path.exists():
+        xml_files = [input_path]
+    elif any(char in str(input) for char in '*?['):
+        xml_files = sorted(Path(file) for file in glob.glob(str(input)))
+    else:
+        xml_files = [input_path]
+    if not xml_files:
+        raise FileNotFoundError(f"No input files found for {input}")
+    return xml_files
+
+# all input files in a directory
+def list_inputs(directory) -> list:
+    return sorted(file for pattern in INPUT_PATTERNS for file in Path(directory).glob(pattern))
+
+# watch a directory and export every new or modified input file to the output directory; the
+# process stays running, so each file only costs its parse time. A file is queued once its size
+# and modification time did not change between two polls, i.e. it has been copied completely,
+# and the exports run one after another in a background thread while the directory is polled
+def watch(args):
+    watch_dir = Path(args.watch)
+    out_dir = Path(args.output) if args.output is not None else watch_dir
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_format = args.format or 'xlsx'
+
+    jobs = queue.Queue()
+    worker = threading.Thread(target=watch_worker, args=(jobs, args, out_format), daemon=True)
+    worker.start()
+
+    last_poll = {} # input file: (size, modification time) in the previous poll
+    queued = {} # input file: (size, modification time) when it was queued
+    print(f"Watching {watch_dir} for new exports, writing to {out_dir}, stop with Ctrl+C")
+    try:
+        while True:
+            poll = {}
+            for xml_file in list_inputs(watch_dir):
+                try:
+                    stat = xml_file.stat()
+                except FileNotFoundError:
+                    continue
+                poll[xml_file] = (stat.st_size, stat.st_mtime_ns)
+                if last_poll.get(xml_file) != poll[xml_file] or queued.get(xml_file) == poll[xml_file]:
+                    continue
+                queued[xml_file] = poll[xml_file]
+
+                # files exported before the watch mode was started are skipped
+                out_file = out_dir / (input_stem(xml_file) + OUTPUT_FORMATS[out_format][0])
+                if out_file.exists() and out_file.stat().st_mtime_ns >= stat.st_mtime_ns:
+                    print(f"Skipping {xml_file}, {out_file} is up to date")
+                    continue
+                print(f"Queued {xml_file} ({jobs.qsize() + 1} waiting)")
+                jobs.put((xml_file, out_file))
+            last_poll = poll
+            time.sleep(args.watch_interval)
+    except KeyboardInterrupt:
+        print(f"Stopping, waiting for the current export to finish")
+        while not jobs.empty():
+            jobs.get_nowait()
+        jobs.put((None, None))
+        worker.join()
+
+# export the files queued by the watch mode with its options; the output is written to a
+# temporary file first, so a partially written output is never taken for a finished one
+def watch_worker(jobs, args, out_format):
+    while True:
+        xml_file, out_file = jobs.get()
+        if xml_file is None:
+            return
+        file_args = argparse.Namespace(**vars(args))
+        file_args.input = xml_file
+        file_args.output = out_file.with_name(out_file.name + '.part')
+        file_args.format = out_format
+        try:
+            main(file_args)
+            os.replace(file_args.output, out_file)
+            print(f"Exported {xml_file} to {out_file}")
+        except Exception as error:
+            print(f"Export of {xml_file} failed: {error!r}")
+            Path(file_args.output).unlink(missing_ok=True)
+
+# load or stream the cases of a single input file, the expat and lxml parsers always stream;
+# with worker processes only the raw XML of the cases is split off, the workers parse it, and
+# the incremental mode only parses the raw XML of cases that are not in the case index
+def load_cases(xml_file, args):
+    if args.workers > 1 or args.incremental:
+        print(f"Splitting cases of input XML file {xml_file}")
+        return iterCaseSlices(xml_file)
+    if args.parser == 'expat':
+        print(f"Streaming cases from input XML file {xml_file} with expat")
+        return iterCasesExpat(xml_file, args, collect_labels=bool(getattr(args, 'catalog', None)))
+    if args.parser == 'lxml':
+        print(f"Streaming cases from input XML file {xml_file} with lxml")
+        return iterCasesLxml(xml_file)
+    if args.stream:
+        print(f"Streaming cases from input XML file {xml_file}")
+        return iterCases(xml_file)
 
     print(f"Loading input XML file {xml_file}")
-    tree = et.parse(xml_file)
+    with open_input(xml_file) as file:
+        tree = et.parse(file)
     root = tree.getroot()
 
     print(f"Getting list of all cases")
     cases = getAllCases(root)
     print(f"Found {len(cases)} cases")
+    return cases
 
-    print(f"Parsing and anonymizing cases")
-    case_assessment_list = []
-    for case in cases:
+# name of an input file without its extension, including the compression suffix
+def input_stem(xml_file):
+    name = Path(xml_file).name
+    for suffix in ['.gz', '.zst', '.zstd', '.zip']:
+        if name.lower().endswith(suffix):
+            name = name[:-len(suffix)]
+    return Path(name).stem
+
+# open an input file for reading; gzip, zstd and zip files are decompressed on the fly in a
+# background thread, so decompression overlaps with parsing, plain files are memory-mapped
+def open_input(xml_file, chunk_size=1 << 22):
+    name = Path(xml_file).name.lower()
+    if name.endswith('.gz'):
+        return ThreadedReader(gzip.open(xml_file, 'rb'), chunk_size)
+    if name.endswith('.zst') or name.endswith('.zstd'):
         try:
-            case_assessment = get_covid_assessment(case, args)
-            case_assessment_list.append(case_assessment)
+            from compression import zstd # python 3.14+
+            return ThreadedReader(zstd.open(xml_file, 'rb'), chunk_size)
+        except ImportError:
+            import zstandard
+            file = open(xml_file, 'rb')
+            return ThreadedReader(zstandard.ZstdDecompressor().stream_reader(file, closefd=True), chunk_size)
+    if name.endswith('.zip'):
+        # the export is the first xml file of the archive, the archive is closed with it
+        with zipfile.ZipFile(xml_file) as archive:
+            members = [member for member in archive.namelist() if member.lower().endswith('.xml')]
+            if not members:
+                raise FileNotFoundError(f"No XML file found in archive {xml_file}")
+            return ThreadedReader(archive.open(members[0]), chunk_size)
+
+    file = open(xml_file, 'rb')
+    try:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError: # empty files cannot be mapped
+        return file
+    file.close()
+    return mapped
+
+# file-like reader that reads the chunks of another file in a background thread
+class ThreadedReader:
+    def __init__(self, file, chunk_size=1 << 22, max_chunks=4):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(max_chunks)
+        self.chunk = b''
+        self.offset = 0
+        self.eof = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._read_chunks, daemon=True)
+        self.thread.start()
+
+    def _read_chunks(self):
+        try:
+            while not self.closed:
+                data = self.file.read(self.chunk_size)
+                self.chunks.put(data)
+                if not data:
+                    break
         except Exception as e:
-            print(f"Error parsing case {case.attrib['CaseID']}")
-            print(e)
+            self.chunks.put(e)
+
+    def read(self, size=-1):
+        parts = []
+        while not self.eof and (size < 0 or size > 0):
+            if self.offset >= len(self.chunk):
+                data = self.chunks.get()
+                if isinstance(data, Exception):
+                    raise data
+                if not data:
+                    self.eof = True
+                    break
+                self.chunk = data
+                self.offset = 0
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.offset + size)
+            parts.append(self.chunk[self.offset:end])
+            if size >= 0:
+                size -= end - self.offset
+            self.offset = end
+        return b''.join(parts)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            # unblock the reader thread if it waits for free space in the queue
+            while self.thread.is_alive():
+                try:
+                    self.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# parse several input files concurrently, one process per file, and merge their cases in
+# the order of the files; cases are deduplicated by their ID and tagged with their source file.
+# The workers write the cases of each file to a JSON lines shard in a temporary directory next
+# to the output, which is read back in file order, so only the IDs are kept in memory
+def process_files(xml_files, args, catalog=None):
+    num_processes = args.workers if args.workers > 1 else min(len(xml_files), os.cpu_count() or 1)
+    seen_ids = set()
+    num_duplicates = 0
+    out_file = Path(args.output)
+    with tempfile.TemporaryDirectory(prefix=out_file.name + '.', suffix='.files', dir=out_file.parent) as shard_dir:
+        shard_files = [Path(shard_dir) / f"file-{index:05d}.jsonl" for index in range(len(xml_files))]
+        with ProcessPoolExecutor(num_processes) as executor:
+            results = executor.map(process_file, xml_files, shard_files, [args] * len(xml_files))
+            for xml_file, shard_file, (num_cases, file_catalog, filter_hits, events) in zip(xml_files, shard_files, results):
+                if catalog is not None:
+                    catalog.merge(file_catalog)
+                args.case_filter.hits.update(filter_hits)
+                EVENTS.update(events)
+                args.run_report.counters['processed_cases'] += num_cases + sum(filter_hits.values()) + events['failed_case']
+                print(f"Parsed {num_cases} cases from {xml_file.name}")
+                with open(shard_file, encoding='utf-8') as file:
+                    for line in file:
+                        case_assessment = json.loads(line)
+                        if case_assessment['ID'] in seen_ids:
+                            num_duplicates += 1
+                            continue
+                        seen_ids.add(case_assessment['ID'])
+                        case_assessment['source'] = xml_file.name
+                        yield case_assessment
+                shard_file.unlink()
+    print(f"Skipped {num_duplicates} duplicate cases")
+
+# parse all cases of a single input file in a batch worker process, the file is always streamed;
+# the cases are written to the shard file, returns their number, the label catalog of the file,
+# if requested, the filter hits and the events
+def process_file(xml_file, shard_file, args):
+    global MAX_MESSAGES
+    MAX_MESSAGES = args.max_messages
+    pop_events()
+    file_args = argparse.Namespace(**vars(args))
+    file_args.stream = True
+    file_args.workers = 1
+    file_args.run_report = None
+    file_args.case_filter = CaseFilter(**args.case_filter.rules())
+    catalog = LabelCatalog(args.catalog_top_k) if args.catalog else None
+    cases = load_cases(xml_file, file_args)
+    num_cases = 0
+    with open(shard_file, 'w', encoding='utf-8') as file:
+        for case_assessment in process_cases(cases, file_args, catalog):
+            if case_assessment is not None:
+                file.write(json.dumps(case_assessment) + '\n')
+                num_cases += 1
+    return num_cases, catalog, file_args.case_filter.hits, pop_events()
+
+# value of --min-age and --max-age turning off the default age limit
+NO_AGE_LIMIT = 'none'
+
+# argument type of the age limits, a number or "none"
+def age_limit(value):
+    if value.strip().lower() == NO_AGE_LIMIT:
+        return NO_AGE_LIMIT
+    return float(value)
+
+# filter deciding per case whether it is exported, the rules are given on the command line
+# or in a JSON rule file with the same keys (min_age, max_age, require, min_labels)
+class CaseFilter:
+    def __init__(self, min_age=None, max_age=100, require=(), min_labels=0):
+        self.min_age = min_age
+        self.max_age = max_age
+        self.require = list(require)
+        self.min_labels = min_labels
+        self.hits = Counter() # number of cases rejected by each rule
+
+    @classmethod
+    def from_args(cls, args):
+        rules = {}
+        if args.filters is not None:
+            with open(args.filters, encoding='utf-8') as file:
+                rules = json.load(file)
+            if not isinstance(rules, dict):
+                raise ValueError(f"Filter rules in {args.filters} must be a JSON object")
+            unknown = set(rules) - {'min_age', 'max_age', 'require', 'min_labels'}
+            if unknown:
+                raise ValueError(f"Unknown filter rules {sorted(unknown)} in {args.filters}")
+            rules = {key: cls.check_rule(key, value, args.filters) for key, value in rules.items()}
+        for key in ['min_age', 'max_age', 'require', 'min_labels']:
+            value = getattr(args, key)
+            if value is not None:
+                rules[key] = None if value == NO_AGE_LIMIT else value
+        return cls(**rules)
+
+    # value of a rule of the rule file in the type the filter uses, as for the command line options
+    @staticmethod
+    def check_rule(key, value, filters_file):
+        if key == 'min_age' or key == 'max_age':
+            if value is None or (isinstance(value, str) and value.strip().lower() == NO_AGE_LIMIT):
+                return None
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return float(value)
+            raise ValueError(f"Filter rule {key} in {filters_file} must be a number, null or \"none\", not {value!r}")
+        if key == 'require':
+            if isinstance(value, list) and all(isinstance(label, str) for label in value):
+                return value
+            raise ValueError(f"Filter rule require in {filters_file} must be a list of labels, not {value!r}")
+        if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+            return value
+        raise ValueError(f"Filter rule {key} in {filters_file} must be a non-negative integer, not {value!r}")
+
+    def rules(self):
+        return {'min_age': self.min_age, 'max_age': self.max_age, 'require': self.require, 'min_labels': self.min_labels}
+
+    # returns the name of the first rule rejecting the case, or None if the case is accepted;
+    # cases without a valid age are only rejected if the age is a required label, ages that
+    # cannot be read are counted as invalid_age events
+    def check(self, case_assessment):
+        for label in self.require:
+            if len(case_assessment.get(label, '')) == 0:
+                return f"require {label}"
+        if self.min_labels and sum(1 for key, value in case_assessment.items() if key != 'ID' and len(value) > 0) < self.min_labels:
+            return "min_labels"
+        if self.min_age is not None or self.max_age is not None:
+            value = case_assessment.get(AGE_LABEL, '')
+            try:
+                age = float(value.replace(',', '.'))
+            except ValueError:
+                age = math.nan
+            if math.isnan(age):
+                if value.strip():
+                    report_event('invalid_age', f"Cannot read age {value!r} of case {case_assessment.get('ID')}, the case is not filtered by age")
+                return None
+            if self.min_age is not None and age < self.min_age:
+                return "min_age"
+            if self.max_age is not None and age >= self.max_age:
+                return "max_age"
+        return None
+
+    def report(self):
+        print(f"Excluded {sum(self.hits.values())} cases by filter rules {self.rules()}")
+        for rule, count in sorted(self.hits.items()):
+            print(f"  {rule}: {count}")
+
+# parse and anonymize a single case, reporting errors instead of raising them;
+# returns the assessment, if requested all labels of the case for the label catalog, and the
+# filter rule that rejected the case; rejected cases are returned without their assessment
+def process_case(case, args, collect_labels=False):
+    labels = {} if collect_labels else None
+    case_filter = getattr(args, 'case_filter', None)
+    try:
+        if isinstance(case, bytes):
+            case = parse_case(case, args, collect_labels)
+        case_assessment = get_covid_assessment(case, args, labels)
+        rejected = None if case_filter is None else case_filter.check(case_assessment)
+        if rejected is not None:
+            return None, labels, rejected
+        return case_assessment, labels, None
+    except Exception as e:
+        # the case info is only printed for the first failed cases, it can be very long
+        if report_event('failed_case', f"Error parsing case {getattr(case, 'attrib', {}).get('CaseID')}: {e}"):
             try:
                 print("Error case info:")
                 print(case.attrib)
-                for c in case:
-                    print(f"{c}: {c.attrib}")
+                if isinstance(case, CaseRecord):
+                    print(f"first child: {case.patient}")
+                else:
+                    for c in case:
+                        print(f"{c}: {c.attrib}")
             except:
-                pass        
+                pass
+    return None, None, None
+
+# parse and anonymize all cases, optionally sharded across a pool of worker processes;
+# results are returned in input order with None for cases that failed or were rejected by the
+# case filter, the labels of all parsed cases are added to the label catalog in the same pass
+def process_cases(cases, args, catalog=None):
+    for case_assessment, rejected in process_case_results(cases, args, catalog):
+        yield case_assessment
+
+# like process_cases, together with the filter rule that rejected the case or None
+def process_case_results(cases, args, catalog=None):
+    run_report = getattr(args, 'run_report', None)
+    for case_assessment, labels, rejected in _process_cases(cases, args, catalog is not None):
+        if labels is not None:
+            catalog.update(labels)
+        if rejected is not None:
+            args.case_filter.hits[rejected] += 1
+        if run_report is not None:
+            run_report.progress()
+        yield case_assessment, rejected
+
+def _process_cases(cases, args, collect_labels):
+    if args.workers <= 1:
+        for case in cases:
+            yield process_case(case, args, collect_labels)
+        return
+
+    # the workers get the raw XML of the cases and parse it themselves, as parsing is the largest
+    # part of the work; the number of chunks in flight is limited to keep memory bounded
+    chunk_size = 64
+    max_pending = args.workers * 4
+    with multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+        pending = deque()
+        chunk = []
+        for case in cases:
+            chunk.append(case_to_xml(case))
+            if len(chunk) >= chunk_size:
+                pending.append(pool.apply_async(_process_case_chunk, (chunk, collect_labels)))
+                chunk = []
+                if len(pending) >= max_pending:
+                    yield from _chunk_results(pending.popleft())
+        if chunk:
+            pending.append(pool.apply_async(_process_case_chunk, (chunk, collect_labels)))
+        while pending:
+            yield from _chunk_results(pending.popleft())
+
+# serialize a case for a worker process, if it has not been split off the input as raw XML;
+# cases of the lxml parser are no ElementTree elements
+def case_to_xml(case):
+    if isinstance(case, bytes):
+        return case
+    if isinstance(case, et.Element):
+        return et.tostring(case)
+    from lxml import etree
+    return etree.tostring(case)
+
+# results of a chunk processed by a worker, the events counted by the worker are added to the own ones
+def _chunk_results(async_result):
+    results, events = async_result.get()
+    EVENTS.update(events)
+    return results
+
+# arguments of the worker processes, set once by the pool initializer
+_worker_args = None
+
+def _init_worker(args):
+    global _worker_args, MAX_MESSAGES
+    _worker_args = args
+    MAX_MESSAGES = args.max_messages
+
+def _process_case_chunk(chunk, collect_labels):
+    results = [process_case(case_xml, _worker_args, collect_labels) for case_xml in chunk]
+    return results, pop_events()
+
+# parse only cases that are new or changed since the last run and store them in the case index;
+# the cases are given as raw XML, unchanged cases are found by the hash of their bytes without
+# parsing them, and cases rejected by the case filter are remembered as well
+def update_case_index(index, cases, args, catalog=None):
+    pending = deque() # positions and fingerprints of the cases handed to process_cases, in order
+    num_unchanged = 0
+
+    def changed_cases():
+        nonlocal num_unchanged
+        for position, case_xml in enumerate(cases):
+            fingerprint = case_fingerprint(case_xml, index.salt)
+            rejected = index.touch(fingerprint, position)
+            if rejected is None:
+                pending.append((position, fingerprint))
+                yield case_xml
+                continue
+            num_unchanged += 1
+            if rejected:
+                args.case_filter.hits[rejected] += 1
+            if catalog is not None:
+                catalog.update(get_covid_assessment_labels(parse_case(case_xml, args, collect_labels=True), args))
 
-    print(f"Building output data")
-    df = pd.DataFrame.from_records(case_assessment_list).transpose()
+    num_updated = 0
+    for case_assessment, rejected in process_case_results(changed_cases(), args, catalog):
+        position, fingerprint = pending.popleft()
+        if case_assessment is not None or rejected is not None:
+            index.store(case_assessment, fingerprint, position, rejected)
+            num_updated += 1
+    index.finish()
+    print(f"Skipped {num_unchanged} unchanged cases, updated {num_updated} cases, removed {index.num_removed} cases")
 
-    # exclude data with age > 100
+# export written in shards of a fixed number of cases next to the output file, with a manifest of
+# the completed shards; an interrupted run can be resumed and only repeats the unfinished shard
+class ChunkedExport:
+    def __init__(self, out_file, xml_file, args, label_schema):
+        self.parts_dir = Path(str(out_file) + '.parts')
+        self.manifest_file = self.parts_dir / 'manifest.json'
+        settings = json.dumps([label_schema, args.case_filter.rules(), args.catalog is not None], sort_keys=True)
+
+        print(f"Hashing input file {xml_file}")
+        manifest = {
+            'input': str(xml_file),
+            'input_sha256': file_sha256(xml_file),
+            'settings': hashlib.sha256(settings.encode()).hexdigest(),
+            'chunk_size': args.chunk_size,
+            'cases_done': 0,
+            'shards': [],
+            'catalog': None, # label catalog of all completed shards
+        }
+
+        self.manifest = manifest
+        if args.resume and self.manifest_file.exists():
+            with open(self.manifest_file, encoding='utf-8') as file:
+                previous = json.load(file)
+            keys = ['input_sha256', 'settings', 'chunk_size']
+            if all(previous.get(key) == manifest[key] for key in keys) and 'catalog' in previous:
+                self.manifest = previous
+                print(f"Resuming export after {previous['cases_done']} cases from {len(previous['shards'])} shards")
+            else:
+                print(f"Input file or settings changed since the last run, starting over")
+        elif self.parts_dir.exists():
+            print(f"Removing shards of a previous run: {self.parts_dir}")
+        if self.manifest is manifest:
+            shutil.rmtree(self.parts_dir, ignore_errors=True)
+        self.parts_dir.mkdir(parents=True, exist_ok=True)
+
+    # parse the cases not done yet and write them to shards, returns the label catalog which is
+    # restored from the previous run when resuming
+    def run(self, cases, args, catalog=None):
+        num_done = self.manifest['cases_done']
+        if catalog is not None and num_done > 0:
+            with open(self.parts_dir / self.manifest['catalog'], 'rb') as file:
+                catalog = pickle.load(file)
+        for shard in self.manifest['shards']:
+            args.case_filter.hits.update(shard['filter_hits'])
+
+        chunk_size = self.manifest['chunk_size']
+        results = process_cases(itertools.islice(cases, num_done, None), args, catalog)
+        while True:
+            hits_before = Counter(args.case_filter.hits)
+            chunk = list(itertools.islice(results, chunk_size))
+            if not chunk:
+                break
+            self.write_shard(chunk, args.case_filter.hits - hits_before, catalog)
+            print(f"Completed {self.manifest['cases_done']} cases in {len(self.manifest['shards'])} shards")
+        return catalog
+
+    # write a shard and update the manifest, both are replaced atomically so that a crash
+    # never leaves a shard behind that is listed in the manifest but incomplete; the catalog is
+    # written under a new name per shard, so replacing the manifest is the only commit point and
+    # a crash before never leaves a catalog that already counts the labels of the shard
+    def write_shard(self, chunk, filter_hits, catalog):
+        shard = {
+            'file': f"shard-{len(self.manifest['shards']):05d}.jsonl",
+            'first_case': self.manifest['cases_done'],
+            'cases': len(chunk),
+            'rows': sum(1 for case_assessment in chunk if case_assessment is not None),
+            'filter_hits': dict(filter_hits),
+        }
+        with open(self.parts_dir / (shard['file'] + '.tmp'), 'w', encoding='utf-8') as file:
+            for case_assessment in chunk:
+                if case_assessment is not None:
+                    file.write(json.dumps(case_assessment) + '\n')
+        os.replace(self.parts_dir / (shard['file'] + '.tmp'), self.parts_dir / shard['file'])
+
+        previous_catalog = self.manifest['catalog']
+        if catalog is not None:
+            catalog_file = f"catalog-{len(self.manifest['shards']):05d}.pickle"
+            with open(self.parts_dir / catalog_file, 'wb') as file:
+                pickle.dump(catalog, file)
+
+        manifest = dict(self.manifest, shards=self.manifest['shards'] + [shard], cases_done=self.manifest['cases_done'] + len(chunk))
+        if catalog is not None:
+            manifest['catalog'] = catalog_file
+        with open(self.manifest_file.with_suffix('.tmp'), 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, indent=4)
+        os.replace(self.manifest_file.with_suffix('.tmp'), self.manifest_file)
+        self.manifest = manifest
+        if previous_catalog is not None and previous_catalog != manifest['catalog']:
+            (self.parts_dir / previous_catalog).unlink(missing_ok=True)
+
+    # rows of all shards in the order of the cases
+    def rows(self):
+        for shard in self.manifest['shards']:
+            with open(self.parts_dir / shard['file'], encoding='utf-8') as file:
+                for line in file:
+                    yield json.loads(line)
+
+    # remove the shards once the output file has been written
+    def cleanup(self):
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
+
+# sha256 hash of a file, read in chunks
+def file_sha256(file_name):
+    hash_object = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for data in iter(lambda: file.read(1 << 22), b''):
+            hash_object.update(data)
+    return hash_object.hexdigest()
+
+# on-disk index of all cases of the last export, mapping the fingerprint of the raw XML of a case to
+# its pseudonymised ID and its extracted row, or the filter rule that rejected it; identical cases
+# that occur several times in an export have one entry per occurrence. Every run only
+# keeps the cases that are part of the current export. The size and modification time of the
+# output file written from the index are kept as well, to find out whether it can be reused
+class CaseIndex:
+    layout = 3 # version of the tables, indexes of older versions are rebuilt
+
+    def __init__(self, index_file, label_schema, case_filter=None):
+        self.salt = json.dumps([label_schema, None if case_filter is None else case_filter.rules()], sort_keys=True)
+        self.connection = sqlite3.connect(index_file)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != self.layout:
+            self.connection.execute("DROP TABLE IF EXISTS cases")
+            self.connection.execute("DROP TABLE IF EXISTS output")
+            self.connection.execute(f"PRAGMA user_version = {self.layout}")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cases (fingerprint TEXT, occurrence INTEGER, id TEXT, row TEXT, rejected TEXT, position INTEGER, run INTEGER, added INTEGER, PRIMARY KEY (fingerprint, occurrence))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS output (file TEXT, format TEXT, size INTEGER, mtime_ns INTEGER)")
+        self.run = self.connection.execute("SELECT COALESCE(MAX(run), 0) + 1 FROM cases").fetchone()[0]
+        self.num_removed = 0
+
+    # mark a case of the previous run as part of the current export, returns None if the case is
+    # not in the index, otherwise the filter rule that rejected it or '' if it is exported; each
+    # entry is only taken once per run, so every occurrence of a repeated case keeps its own row
+    def touch(self, fingerprint, position):
+        result = self.connection.execute("SELECT occurrence, rejected FROM cases WHERE fingerprint = ? AND run < ? ORDER BY occurrence LIMIT 1",
+                                         (fingerprint, self.run)).fetchone()
+        if result is None:
+            return None
+        self.connection.execute("UPDATE cases SET position = ?, run = ? WHERE fingerprint = ? AND occurrence = ?", (position, self.run, fingerprint, result[0]))
+        return result[1] or ''
+
+    def store(self, case_assessment, fingerprint, position, rejected=None):
+        case_id, row = (None, None) if case_assessment is None else (case_assessment['ID'], json.dumps(case_assessment))
+        self.connection.execute("INSERT INTO cases (fingerprint, occurrence, id, row, rejected, position, run, added) "
+                                "SELECT ?, COALESCE(MAX(occurrence), -1) + 1, ?, ?, ?, ?, ?, ? FROM cases WHERE fingerprint = ?",
+                                (fingerprint, case_id, row, rejected, position, self.run, self.run, fingerprint))
+
+    # remove all cases that are not part of the current export, i.e. removed or modified cases
+    def finish(self):
+        self.num_removed = self.connection.execute("DELETE FROM cases WHERE run < ?", (self.run,)).rowcount
+        self.connection.commit()
+
+    # 'unchanged' if the output file of the last run is still up to date, 'append' if it can be
+    # extended with the cases added in this run, as these follow all other cases, else 'rewrite';
+    # only files that have not been modified since the last run are reused
+    def output_mode(self, out_file, out_format):
+        previous = self.connection.execute("SELECT file, format, size, mtime_ns FROM output").fetchone()
+        try:
+            stat = os.stat(out_file)
+        except FileNotFoundError:
+            return 'rewrite'
+        if previous != (str(Path(out_file).resolve()), out_format, stat.st_size, stat.st_mtime_ns) or self.num_removed > 0:
+            return 'rewrite'
+        first_added, = self.connection.execute("SELECT MIN(position) FROM cases WHERE added = ?", (self.run,)).fetchone()
+        if first_added is None:
+            return 'unchanged'
+        last_kept, = self.connection.execute("SELECT MAX(position) FROM cases WHERE added < ?", (self.run,)).fetchone()
+        if out_format in APPENDABLE_FORMATS and (last_kept is None or last_kept < first_added):
+            return 'append'
+        return 'rewrite'
+
+    def record_output(self, out_file, out_format):
+        stat = os.stat(out_file)
+        self.connection.execute("DELETE FROM output")
+        self.connection.execute("INSERT INTO output VALUES (?, ?, ?, ?)", (str(Path(out_file).resolve()), out_format, stat.st_size, stat.st_mtime_ns))
+        self.connection.commit()
+
+    def rows(self):
+        for (row,) in self.connection.execute("SELECT row FROM cases WHERE row IS NOT NULL ORDER BY position"):
+            yield json.loads(row)
+
+    # rows of the cases added in this run
+    def added_rows(self):
+        for (row,) in self.connection.execute("SELECT row FROM cases WHERE row IS NOT NULL AND added = ? ORDER BY position", (self.run,)):
+            yield json.loads(row)
+
+    def close(self):
+        self.connection.close()
+
+# number of noteworthy events per kind (failed cases, hash fallbacks, ...), messages of each
+# kind are only printed up to MAX_MESSAGES times per process so a bad run is not slowed down
+EVENTS = Counter()
+MAX_MESSAGES = 10
+_printed_messages = Counter()
+
+# count an event and print its message, returns whether the message was printed
+def report_event(kind, message):
+    EVENTS[kind] += 1
+    if _printed_messages[kind] >= MAX_MESSAGES:
+        return False
+    _printed_messages[kind] += 1
+    print(message)
+    if _printed_messages[kind] == MAX_MESSAGES:
+        print(f"Further messages of type {kind} are suppressed")
+    return True
+
+# return and reset the events counted so far, used to collect the events of worker processes
+def pop_events():
+    events = Counter(EVENTS)
+    EVENTS.clear()
+    return events
+
+# wall time, cpu time and peak memory of all stages of a run, counters of cases and events and
+# the progress of the run; written as a machine-readable JSON report when the run has finished
+class RunReport:
+    progress_interval = 10.0 # seconds between progress messages
+
+    def __init__(self, args):
+        self.info = {
+            'input': str(args.input),
+            'output': str(args.output),
+            'format': args.format,
+            'stream': args.stream,
+            'workers': args.workers,
+            'incremental': args.incremental is not None,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        }
+        self.started = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_time()
+        self.stages = []
+        self.counters = Counter()
+        self.filter_hits = {}
+        self.last_progress = self.start_wall
+        self.last_progress_cases = 0
+        self.peak_rss_mb = 0.0 # peak of this process in all stages, the peak is reset per stage
+
+    # the peak memory of a stage is only known where the peak can be reset (Linux), otherwise
+    # the largest resident memory of the run so far is reported under a different name
+    @contextlib.contextmanager
+    def stage(self, name):
+        self.peak_rss_mb = max(self.peak_rss_mb, read_peak_rss_mb() or 0.0)
+        per_stage_peak = reset_peak_rss()
+        start_wall = time.perf_counter()
+        start_cpu = cpu_time()
+        start_cases = self.counters['processed_cases']
+        try:
+            yield
+        finally:
+            wall_seconds = time.perf_counter() - start_wall
+            num_cases = self.counters['processed_cases'] - start_cases
+            stage = {
+                'name': name,
+                'wall_seconds': wall_seconds,
+                'cpu_seconds': cpu_time() - start_cpu,
+                'cases': num_cases,
+                'cases_per_second': num_cases / wall_seconds if wall_seconds > 0 else None,
+            }
+            if per_stage_peak:
+                stage['peak_rss_mb'] = read_peak_rss_mb()
+                self.peak_rss_mb = max(self.peak_rss_mb, stage['peak_rss_mb'] or 0.0)
+            else:
+                stage['max_rss_so_far_mb'] = peak_rss_mb()
+            self.stages.append(stage)
+
+    # count a processed case and print the throughput every progress_interval seconds
+    def progress(self):
+        self.counters['processed_cases'] += 1
+        now = time.perf_counter()
+        if now - self.last_progress >= self.progress_interval:
+            rate = (self.counters['processed_cases'] - self.last_progress_cases) / (now - self.last_progress)
+            print(f"Processed {self.counters['processed_cases']} cases ({rate:.0f} cases/s)")
+            self.last_progress = now
+            self.last_progress_cases = self.counters['processed_cases']
+
+    # peak resident memory of the whole run, of this process and the largest finished child process
+    def run_peak_rss_mb(self):
+        peak = peak_rss_mb()
+        if peak is not None and self.peak_rss_mb > 0:
+            peak['self'] = max(peak['self'], self.peak_rss_mb)
+        return peak
+
+    def to_dict(self, status):
+        wall_seconds = time.perf_counter() - self.start_wall
+        return {
+            'status': status,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': cpu_time() - self.start_cpu,
+            'cases_per_second': self.counters['processed_cases'] / wall_seconds if wall_seconds > 0 else None,
+            'peak_rss_mb': self.run_peak_rss_mb(),
+            'run': self.info,
+            'stages': self.stages,
+            'counters': dict(self.counters),
+            'events': dict(EVENTS),
+            'filter_hits': self.filter_hits,
+        }
+
+    # print a summary of the run and write the report file, if requested
+    def finish(self, status, report_file=None):
+        report = self.to_dict(status)
+        print(f"Run {status} after {report['wall_seconds']:.1f} s, {self.counters['processed_cases']} cases processed")
+        for kind, count in sorted(EVENTS.items()):
+            print(f"  {kind}: {count}")
+        if report_file is not None:
+            with open(report_file, 'w', encoding='utf-8') as file:
+                json.dump(report, file, indent=4)
+            print(f"Wrote run report: {report_file}")
+
+# cpu time of this process and all finished child processes, e.g. the worker processes
+def cpu_time():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+# peak resident memory of this process since the start or the last reset_peak_rss, only on Linux
+def read_peak_rss_mb():
     try:
-        age_cols = df.columns[list(df.loc['racoon-covid-19-demographic-information-age2',:].notna())]
-        age_ecld = df.loc['racoon-covid-19-demographic-information-age2', age_cols].astype(int) >= 100
-        df = df.drop(age_ecld.index[age_ecld], axis = 1)
-    except:
+        with open('/proc/self/status', encoding='ascii') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except (OSError, ValueError):
         pass
+    return None
+
+# reset the peak resident memory of this process, this resets ru_maxrss as well;
+# returns whether the peak could be reset
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as file:
+            file.write('5')
+    except OSError:
+        return False
+    return read_peak_rss_mb() is not None
+
+# peak resident memory of this process and the largest finished child process, if available
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return {'self': psutil.Process().memory_info().peak_wset / 2**20, 'children': None}
+        except (ImportError, AttributeError):
+            return None
+    scale = 2**20 if platform.system() == 'Darwin' else 2**10 # ru_maxrss is given in bytes on macOS
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    }
+
+# output formats and the file extensions they are selected by
+OUTPUT_FORMATS = {
+    'xlsx': ['.xlsx'],
+    'csv': ['.csv'],
+    'parquet': ['.parquet', '.pq'],
+    'arrow': ['.arrow', '.feather', '.ipc'],
+}
+
+# output formats a file of a previous run can be extended in
+APPENDABLE_FORMATS = ['csv']
+
+# output format of a file, the format defaults to the one matching its extension
+def output_format(out_file, out_format=None):
+    if out_format is None:
+        suffix = Path(out_file).suffix.lower()
+        out_format = next((fmt for fmt, suffixes in OUTPUT_FORMATS.items() if suffix in suffixes), 'xlsx')
+    return out_format
+
+# open the writer for the given output file, with append the rows are added to an existing file
+def open_writer(out_file, out_format=None, label_schema=None, extra_columns=(), append=False):
+    if label_schema is None:
+        label_schema = load_label_schema()
+    out_format = output_format(out_file, out_format)
+    if append and out_format not in APPENDABLE_FORMATS:
+        raise ValueError(f"Cannot append to {out_format} file {out_file}")
+
+    writers = {
+        'xlsx': XlsxWriter,
+        'csv': CsvWriter,
+        'parquet': ParquetWriter,
+        'arrow': ArrowWriter,
+    }
+    if append:
+        return writers[out_format](out_file, label_schema, extra_columns, append=True)
+    return writers[out_format](out_file, label_schema, extra_columns)
+
+# base class of all output writers, rows are buffered and written in batches with typed columns;
+# extra columns (e.g. the source file) are written as strings between the ID and the labels
+class OutputWriter:
+    def __init__(self, out_file, label_schema, extra_columns=(), batch_size=10000):
+        self.out_file = out_file
+        self.label_schema = label_schema
+        self.extra_columns = list(extra_columns)
+        self.columns = ['ID'] + self.extra_columns + list(label_schema)
+        self.batch_size = batch_size
+        self.categories = None # categories of categorical columns kept across batches, if required
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            import pandas as pd
+            batch = pd.DataFrame.from_records(self.rows, columns=self.columns)
+            self.rows = []
+            self.write_batch(coerce_columns(batch, self.label_schema, self.categories))
+
+    def close(self):
+        self.flush()
 
-    # save to file
-    print(f"Writing output file: {args.output}")
-    df.to_excel(args.output)
+    def write_batch(self, batch):
+        raise NotImplementedError
 
-# get list of all available labels, including a unique list of the values
+# writers of row based formats convert each row on its own with coerce_value instead of in
+# batches, so the csv and xlsx export does not need pandas
+class RowWriter(OutputWriter):
+    def __init__(self, out_file, label_schema, extra_columns=(), batch_size=10000):
+        super().__init__(out_file, label_schema, extra_columns, batch_size)
+        # category and string values are written as they are, only the other columns are converted
+        first = len(self.extra_columns) + 1
+        self.converted = [(first + index, label, dtype) for index, (label, dtype) in enumerate(label_schema.items()) if dtype in ('int', 'float', 'bool')]
+
+    def write(self, row):
+        values = [row.get(column) for column in self.columns]
+        for index, label, dtype in self.converted:
+            value = values[index]
+            if value is not None:
+                values[index] = coerce_value(value, dtype)
+                if values[index] is None and value.strip():
+                    report_invalid_value(label, dtype, value)
+        self.write_row(values)
+
+    def write_row(self, values):
+        raise NotImplementedError
+
+# plain csv file, written in the same format as by pandas
+class CsvWriter(RowWriter):
+    def __init__(self, out_file, label_schema, extra_columns=(), batch_size=10000, append=False):
+        super().__init__(out_file, label_schema, extra_columns, batch_size)
+        self.file = open(out_file, 'a' if append else 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file, lineterminator=os.linesep)
+        if not append:
+            self.writer.writerow(self.columns)
+
+    def write_row(self, values):
+        self.writer.writerow(values)
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+# excel file written with the openpyxl write-only mode, rows are streamed into the sheet
+class XlsxWriter(RowWriter):
+    def __init__(self, out_file, label_schema, extra_columns=(), batch_size=10000):
+        super().__init__(out_file, label_schema, extra_columns, batch_size)
+        import openpyxl
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet()
+        self.sheet.append(self.columns)
+
+    def write_row(self, values):
+        self.sheet.append(values)
+
+    def close(self):
+        super().close()
+        self.workbook.save(self.out_file)
+
+# apache arrow based writers with typed columns; categorical columns are dictionary encoded
+# and their categories only grow, so every batch can be written with the same schema
+class ArrowWriter(OutputWriter):
+    def __init__(self, out_file, label_schema, extra_columns=(), batch_size=10000):
+        super().__init__(out_file, label_schema, extra_columns, batch_size)
+        import pyarrow as pa
+        self.pa = pa
+        arrow_types = {
+            'category': pa.dictionary(pa.int32(), pa.string()),
+            'int': pa.int64(),
+            'float': pa.float64(),
+            'bool': pa.bool_(),
+            'string': pa.string(),
+        }
+        self.schema = pa.schema([(column, pa.string()) for column in ['ID'] + self.extra_columns] + [(label, arrow_types[dtype]) for label, dtype in label_schema.items()])
+        self.categories = {}
+        self.writer = self.open(out_file)
+
+    def open(self, out_file):
+        return self.pa.ipc.new_file(out_file, self.schema, options=self.pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def write_batch(self, batch):
+        self.writer.write_table(self.pa.Table.from_pandas(batch, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+class ParquetWriter(ArrowWriter):
+    def open(self, out_file):
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(out_file, self.schema)
+
+# load the label schema, the file is only read and validated once per process
+@functools.lru_cache(maxsize=None)
+def load_label_schema(schema_file=None) -> dict:
+    if schema_file is None:
+        schema_file = LABEL_SCHEMA_FILE
+    with open(schema_file, encoding='utf-8') as file:
+        label_schema = json.load(file)
+    for label, dtype in label_schema.items():
+        if dtype not in LABEL_DTYPES:
+            raise ValueError(f"Unknown data type {dtype} for label {label} in {schema_file}, expected one of {LABEL_DTYPES}")
+    return label_schema
+
+# answers accepted for boolean labels
+BOOL_VALUES = {'true': True, 'yes': True, 'ja': True, '1': True,
+               'false': False, 'no': False, 'nein': False, '0': False}
+
+# numbers accepted for int and float labels, after a decimal comma is replaced by a point; only
+# ASCII digits are accepted, python would read other digits like '٣' or '１２' as well. The
+# pattern is used by both coerce_value and coerce_columns, so it must not rely on python's re
+NUMBER_PATTERN = r'[+-]?(?:(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?|[iI][nN][fF](?:[iI][nN][iI][tT][yY])?|[nN][aA][nN])'
+NUMBER = re.compile(NUMBER_PATTERN)
+
+# convert the string values of whole columns to the data types given by the label schema,
+# values that cannot be converted become missing values and are reported per label
+def coerce_columns(df, label_schema, categories=None):
+    import pandas as pd
+    for label, dtype in label_schema.items():
+        values = df[label].astype('string')
+        if dtype == 'int' or dtype == 'float':
+            # pd.to_numeric does not round long numbers correctly, the cast matches float()
+            texts = values.str.replace(',', '.', regex=False).str.strip()
+            numbers = texts.where(texts.str.fullmatch(NUMBER_PATTERN).fillna(False)).astype('float64')
+            if dtype == 'int':
+                # values outside of the int64 range would wrap around
+                numbers = numbers.where((numbers % 1 == 0) & (numbers >= -2**63) & (numbers < 2**63)).astype('Int64')
+            else:
+                numbers = numbers.astype('float64')
+            df[label] = numbers
+        elif dtype == 'bool':
+            df[label] = values.str.strip().str.lower().map(BOOL_VALUES).astype('boolean')
+        elif dtype == 'category':
+            if categories is None:
+                df[label] = values.astype('category')
+            else:
+                known = categories.setdefault(label, [])
+                seen = set(known)
+                known.extend(value for value in values.dropna().unique() if value not in seen)
+                df[label] = pd.Categorical(values, categories=known)
+        else:
+            df[label] = values
+        if dtype == 'int' or dtype == 'float' or dtype == 'bool':
+            invalid = df[label].isna() & (values.str.strip().fillna('') != '')
+            for value in values[invalid]:
+                report_invalid_value(label, dtype, value)
+    return df
+
+# convert a single value like coerce_columns, used by the row based writers; missing values and
+# values that cannot be converted are returned as None
+def coerce_value(value, dtype):
+    if value is None:
+        return None
+    if dtype == 'int' or dtype == 'float':
+        text = value.replace(',', '.').strip()
+        if NUMBER.fullmatch(text) is None:
+            return None
+        number = float(text)
+        if dtype == 'int':
+            return int(number) if number.is_integer() and -2**63 <= number < 2**63 else None
+        return None if math.isnan(number) else number
+    if dtype == 'bool':
+        return BOOL_VALUES.get(value.strip().lower())
+    return value
+
+# values that cannot be converted to the data type of their label are left empty, they are
+# counted per label so the data loss shows up in the run report
+def report_invalid_value(label, dtype, value):
+    report_event(f"invalid_value {label}", f"Cannot convert {value!r} of {label} to {dtype}, the value is left empty")
+
+# get list of all available labels, including statistics of their values
 def get_label_list(cases, out_file, args):
-    labels = []
+    catalog = LabelCatalog(getattr(args, 'catalog_top_k', 10))
     for case in cases:
-        labels.append(get_covid_assessment_labels(case, args))
-    labels_merge = {}
-    for label in labels:
-        for key in label.keys():
-            if key in labels_merge.keys():
-                labels_merge[key][1].append(label[key][1])
+        catalog.update(get_covid_assessment_labels(case, args))
+    catalog.save(out_file)
+
+# catalog of all labels of an export with the question text and statistics of their values;
+# the memory usage is bounded by using fixed-size sketches for the value statistics
+class LabelCatalog:
+    def __init__(self, top_k=10):
+        self.top_k = top_k
+        self.num_cases = 0
+        self.labels = {} # label: [question text, number of non-empty values, DistinctCounter, TopValues]
+
+    # add the labels of a single case, as returned by get_covid_assessment_labels
+    def update(self, case_labels):
+        self.num_cases += 1
+        for label, (text, value) in case_labels.items():
+            entry = self.labels.get(label)
+            if entry is None:
+                entry = self.labels[label] = [text, 0, DistinctCounter(), TopValues(self.top_k * 10)]
+            if len(value) > 0:
+                entry[1] += 1
+                entry[2].add(value)
+                entry[3].add(value)
+
+    # add the statistics of another catalog, e.g. built by a worker process
+    def merge(self, other):
+        self.num_cases += other.num_cases
+        for label, (text, num_filled, distinct, top_values) in other.labels.items():
+            entry = self.labels.get(label)
+            if entry is None:
+                self.labels[label] = [text, num_filled, distinct, top_values]
             else:
-                labels_merge[key] = label[key]
-                labels_merge[key][1] = [labels_merge[key][1]]
-    for key in labels_merge.keys():
-        labels_merge[key][1] = list(set(labels_merge[key][1]))
+                entry[1] += num_filled
+                entry[2].merge(distinct)
+                entry[3].merge(top_values)
+
+    def to_frame(self):
+        records = {}
+        for label, (text, num_filled, distinct, top_values) in sorted(self.labels.items()):
+            records[label] = {
+                'Question': text,
+                'Distinct values': distinct.count(),
+                'Top values': '; '.join(f"{value} ({count})" for value, count in top_values.most_common(self.top_k)),
+                'Fill rate': num_filled / self.num_cases if self.num_cases else 0.0,
+            }
+        import pandas as pd
+        return pd.DataFrame.from_records(records).transpose()
+
+    def save(self, out_file):
+        df = self.to_frame()
+        if Path(out_file).suffix.lower() == '.csv':
+            df.to_csv(out_file)
+        else:
+            df.to_excel(out_file)
 
-    df = pd.DataFrame.from_records(labels_merge).transpose()
-    df.to_excel(out_file)
+# number of distinct values, counted exactly for few values and estimated with a
+# HyperLogLog sketch of fixed size once the exact set would grow too large
+class DistinctCounter:
+    precision = 12   # 4096 registers, about 1.6% standard error
+    max_exact = 1024
+
+    def __init__(self):
+        self.values = set()
+        self.registers = None
+
+    def add(self, value):
+        if self.registers is None:
+            self.values.add(value)
+            if len(self.values) > self.max_exact:
+                self.registers = bytearray(1 << self.precision)
+                for exact_value in self.values:
+                    self._add_hashed(exact_value)
+                self.values = None
+        else:
+            self._add_hashed(value)
+
+    def _add_hashed(self, value):
+        hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        remainder = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.registers is None:
+            for value in other.values:
+                self.add(value)
+            return
+        if self.registers is None:
+            values = self.values
+            self.values = None
+            self.registers = bytearray(other.registers)
+            for value in values:
+                self._add_hashed(value)
+        else:
+            self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        if self.registers is None:
+            return len(self.values)
+        num_registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / num_registers)
+        estimate = alpha * num_registers ** 2 / sum(2.0 ** -register for register in self.registers)
+        num_zero = self.registers.count(0)
+        if estimate <= 2.5 * num_registers and num_zero > 0:
+            estimate = num_registers * math.log(num_registers / num_zero) # linear counting for small ranges
+        return int(round(estimate))
+
+# most frequent values with their counts, tracked with the space-saving algorithm in a
+# fixed number of counters; counts of values that were evicted before are overestimated.
+# The counter to evict is found with a min-heap that is updated lazily: counts only grow, so
+# an entry is only corrected once it reaches the top, which keeps add at O(log capacity)
+class TopValues:
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = {}
+        self.heap = [] # (count, insertion number, value) per value, the count may be outdated
+        self.num_inserted = 0
+
+    def add(self, value, count=1):
+        counts = self.counts
+        if value in counts:
+            counts[value] += count
+            return
+        if len(counts) >= self.capacity:
+            count += self.evict()
+        counts[value] = count
+        heapq.heappush(self.heap, (count, self.num_inserted, value))
+        self.num_inserted += 1
+
+    # remove the value with the smallest count, of equal counts the one inserted first, and
+    # return its count
+    def evict(self):
+        heap = self.heap
+        while True:
+            count, number, value = heap[0]
+            if self.counts[value] == count:
+                heapq.heappop(heap)
+                return self.counts.pop(value)
+            heapq.heapreplace(heap, (self.counts[value], number, value))
+
+    def merge(self, other):
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+        if len(self.counts) > self.capacity:
+            self.counts = dict(self.most_common(self.capacity))
+        self.heap = [(count, number, value) for number, (value, count) in enumerate(self.counts.items())]
+        heapq.heapify(self.heap)
+        self.num_inserted = len(self.heap)
+
+    def most_common(self, n):
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:n]
 
 # parse information regarding covid assessment
-def get_covid_assessment(case, args):
-    label_list = ['racoon-covid-19-cohort-primary-category',
-                  'racoon-covid-19-outcome-parameter-last-documented-patient-outcome-description',
-                  'racoon-covid-19-outcome-parameter-worst-treatment-state-during-admission2',
-                  'racoon-covid-19-outcome-parameter-existing-signs-of-pulmonal-complications',
-                  'racoon-covid-19-treatment-protocol-oxygen-therapy',
-                  'racoon-covid-19-treatment-protocol-lopinavir-ritonavir',
-                  'racoon-covid-19-treatment-protocol-remdesivir',
-                  'racoon-covid-19-treatment-protocol-antibiotics',
-                  'racoon-covid-19-treatment-protocol-antibiotics-carbapeneme',
-                  'racoon-covid-19-treatment-protocol-antibiotics-tazobactam',
-                  'racoon-covid-19-treatment-protocol-antibiotics-sublactam-ampicillin',
-                  'racoon-covid-19-treatment-protocol-antibiotics-sublactam-clarithromycin',
-                  'racoon-covid-19-treatment-protocol-antibiotics-azithromycin',
-                  'racoon-covid-19-treatment-protocol-oxygen-therapy-type',
-                  'racoon-covid-19-treatment-protocol-thrombosis-prophylaxis',
-                  'racoon-covid-19-treatment-protocol-methylprednisolone',
-                  'racoon-covid-19-treatment-protocol-hydroxychloroquine',
-                  'racoon-covid-19-treatment-protocol-chloroquine',
-                  'racoon-covid-19-lung-parenchyma-emphysema-localization-lobes2',
-                  'racoon-covid-19-lung-parenchyma-emphysema-ancillary-feature-paraseptal2',
-                  'racoon-covid-19-lung-parenchyma-emphysema-dominant-pattern2',
-                  'racoon-covid-19-lung-parenchyma-emphysema-ancillary-feature-bullous2',
-                  'racoon-covid-19-lung-parenchyma-reticulation-localization-lobes2',
-                  'racoon-covid-19-lung-parenchyma-reticulation-ancillary-feature-subpleural-sparing2',
-                  'racoon-covid-19-lung-parenchyma-reticulation-ancillary-feature-with-honeycombing2',
-                  'racoon-covid-19-lung-parenchyma-reticulation-dominant-distribution-geographic2',
-                  'racoon-covid-19-lung-parenchyma-reticulation-dominant-distribution-anatomic2',
-                  'racoon-covid-19-lung-parenchyma-cavitation-localization-lobes2',
-                  'racoon-covid-19-lung-parenchyma-cavitation-ancillary-feature-with-halo2',
-                  'racoon-covid-19-lung-parenchyma-cavitation-ancillary-feature-thin-walled-cystic',
-                  'racoon-covid-19-lung-parenchyma-cavitation-ancillary-feature-with-air-fluid-level2',
-                  'racoon-covid-19-lung-parenchyma-cavitation-ancillary-feature-with-air-crescent2',
-                  'racoon-covid-19-lung-parenchyma-mass-larger-thirty-mm-localization-lobes2',
-                  'racoon-covid-19-lung-parenchyma-mass-larger-thirty-mm-ancillary-feature-with-melting2',
-                  'racoon-covid-19-lung-parenchyma-mass-larger-thirty-mm-ancillary-feature-with-halo2',
-                  'racoon-covid-19-lung-parenchyma-mass-larger-thirty-mm-ancillary-feature-calciferous2',
-                  'racoon-covid-19-lung-parenchyma-mass-larger-thirty-mm-ancillary-feature-with-infiltration-into-surroundings2',
-                  'racoon-covid-19-lung-parenchyma-nodule-localization-lobes2',
-                  'racoon-covid-19-lung-parenchyma-nodule-ancillary-feature-non-solid2',
-                  'racoon-covid-19-lung-parenchyma-nodule-ancillary-feature-with-melting2',
-                  'racoon-covid-19-lung-parenchyma-nodule-ancillary-feature-calciferous2',
-                  'racoon-covid-19-lung-parenchyma-nodule-ancillary-feature-irregular-with-halo',
-                  'racoon-covid-19-lung-parenchyma-nodule-dominant-distribution-geographic2',
-                  'racoon-covid-19-lung-parenchyma-nodule-dominant-distribution-anatomic2',
-                  'racoon-covid-19-lung-parenchyma-micronoduli-localization-lobes2',
-                  'racoon-covid-19-lung-parenchyma-micronoduli-ancillary-feature-calciferous2',
-                  'racoon-covid-19-lung-parenchyma-micronoduli-ancillary-feature-non-solid2',
-                  'racoon-covid-19-lung-parenchyma-micronoduli-dominant-distribution-geographic2',
-                  'racoon-covid-19-lung-parenchyma-micronoduli-dominant-distribution-anatomic2',
-                  'racoon-covid-19-bronchi-bronchus-wall-thickening-localization-lobes2',
-                  'racoon-covid-19-bronchi-bronchus-wall-thickening-dominant-distribution2',
-                  'racoon-covid-19-bronchi-bronchiectasis-localization-lobes2',
-                  'racoon-covid-19-bronchi-bronchiectasis-ancillary-feature-with-traction2',
-                  'racoon-covid-19-bronchi-bronchiectasis-dominant-distribution2',
-                  'racoon-covid-19-bronchi-bronchiectasis-ancillary-feature-mucus-plugging2',
-                  'racoon-covid-19-pleura-pleural-effusion-hyperdense-greater-twenty-hu2',
-                  'racoon-covid-19-pleura-pleural-effusion-trapped2',
-                  'racoon-covid-19-patient-intubation-status-intubated',
-                  'racoon-covid-19-pleura-pleural-disease-ancillary-feature-calciferous2',
-                  'racoon-covid-19-vessels-arterial-occlusion',
-                  'racoon-covid-19-vessels-arterial-occlusion-calciferous2',
-                  'racoon-covid-19-vessels-pulmonal-trunk-diameter-larger-than-aorta2',
-                  'racoon-covid-19-mediastinum-lymphadenopathy-tumor-presence',
-                  'racoon-covid-19-mediastinum-lymphadenopathy-tumor-ancillary-feature-calciferous2',
-                  'racoon-covid-19-mediastinum-pericardial-effusion',
-                  'racoon-covid-19-mediastinum-atherosclerosis',
-                  'racoon-covid-19-mediastinum-aorta-sclerosis',
-                  'racoon-covid-19-sars-ct-score-total',
-                  'racoon-covid-19-imaging-classification',
-                  'racoon-covid-19-imaging-classification-corads',
-                  'racoon-covid-19-imaging-classification-covrads',
-                  'racoon-covid-19-annotation-pathology-lung-parenchyma',
-                  'racoon-covid-19-lung-parenchyma-atelectasis-scar-localization2',
-                  'racoon-covid-19-lung-parenchyma-atelectasis-scar-dominant-distribution2',
-                  'racoon-covid-19-lung-parenchyma-atelectasis-scar-ancillary-feature-radial-distribution2',
-                  'racoon-covid-19-lung-parenchyma-atelectasis-scar-ancillary-feature-curvilinear-pattern2',
-                  'racoon-covid-19-lung-parenchyma-atelectasis-scar-ancillary-feature-calciferous2',
-                  'racoon-covid-19-specific-radiological-signs-lung-parenchyma-assessment',
-                  'racoon-covid-19-specific-radiological-signs-bronchi-assessment',
-                  'racoon-covid-19-specific-radiological-signs-pleura-assessment',
-                  'racoon-covid-19-lung-parenchyma-atelectasis-scar-presence',
-                  'racoon-covid-19-lung-parenchyma-consolidation-presence',
-                  'racoon-covid-19-lung-parenchyma-ground-glass-region-presence',
-                  'racoon-covid-19-lung-parenchyma-emphysema-presence',
-                  'racoon-covid-19-lung-parenchyma-reticulation-presence',
-                  'racoon-covid-19-lung-parenchyma-cavitation-presence',
-                  'racoon-covid-19-lung-parenchyma-mass-larger-thirty-mm-presence',
-                  'racoon-covid-19-lung-parenchyma-nodule-presence',
-                  'racoon-covid-19-lung-parenchyma-micronoduli-presence',
-                  'racoon-covid-19-bronchi-bronchus-wall-thickening-presence',
-                  'racoon-covid-19-bronchi-bronchiectasis-presence',
-                  'racoon-covid-19-pleura-pneumothorax-presence',
-                  'racoon-covid-19-pleura-pleural-effusion-presence',
-                  'racoon-covid-19-pleura-pleural-disease-presence',
-                  'racoon-covid-19-lung-parenchyma-consolidation-localization-lobes2',
-                  'racoon-covid-19-lung-parenchyma-consolidation-ancillary-features-subpleural-sparing2',
-                  'racoon-covid-19-lung-parenchyma-consolidation-dominant-distribution-geographic2',
-                  'racoon-covid-19-lung-parenchyma-consolidation-dominant-distribution-anatomic2',
-                  'racoon-covid-19-lung-parenchyma-ground-glass-region-localization-lobes2',
-                  'racoon-covid-19-lung-parenchyma-ground-glass-region-ancillary-feature-with-consolidation-within-ground-glass2',
-                  'racoon-covid-19-lung-parenchyma-ground-glass-region-ancillary-feature-with-vessel-thickening-hyperemia2',
-                  'racoon-covid-19-lung-parenchyma-ground-glass-region-ancillary-feature-subpleural-sparing2',
-                  'racoon-covid-19-lung-parenchyma-ground-glass-region-ancillary-feature-with-crazy-paving2',
-                  'racoon-covid-19-lung-parenchyma-ground-glass-region-ancillary-feature-with-reversed-halo2',
-                  'racoon-covid-19-lung-parenchyma-ground-glass-region-ancillary-feature-with-vacuole-sign2',
-                  'racoon-covid-19-lung-parenchyma-ground-glass-region-dominant-distribution-geographic2',
-                  'racoon-covid-19-lung-parenchyma-ground-glass-region-dominant-distribution-anatomic2',
-                  'racoon-covid-19-demographic-information-age2',
-                  'racoon-covid-19-demographic-information-gender',
-                  'racoon-covid-19-contact-to-infected-patients',
-                  'racoon-covid-19-emphysem',
-                  'racoon-covid-19-copd',
-                  'racoon-covid-19-hypertension',
-                  'racoon-covid-19-cardiac-disease',
-                  'racoon-covid-19-cardiac-disease-congestion',
-                  'racoon-covid-19-liver-disease',
-                  'racoon-covid-19-chronic-kidney-disease',
-                  'racoon-covid-19-chronic-kidney-disease-dialysis',
-                  'racoon-covid-19-diabetes-mellitus-presence-type',
-                  'racoon-covid-19-diabetes-insulin-therapy',
-                  'racoon-covid-19-lung-fibrosis',
-                  'racoon-covid-19-comorbidities-known',
-                  'racoon-covid-19-immunsuppresion',
-                  'racoon-covid-19-malignoma-metastatic-disease',
-                  'racoon-covid-19-smoking',
-                  'racoon-covid-19-pack-years',
-                  'racoon-covid-19-abdominal-symptoms',
-                  'racoon-covid-19-cardiac-symptoms',
-                  'racoon-covid-19-fever2',
-                  'racoon-covid-19-respiratoy-frequency',
-                  'racoon-covid-19-systolic-pressure',
-                  'racoon-covid-19-oxygen-saturation',
-                  'racoon-covid-19-respiratory-symptoms2',
-                  'racoon-covid-19-neurological-symptoms',
-                  'racoon-covid-19-rt-pcr-assay3',
-                  'racoon-covid-19-monocytes',
-                  'racoon-covid-19-platelets',
-                  'racoon-covid-19-hemoglobin',
-                  'racoon-covid-19-white-blood-cells',
-                  'racoon-covid-19-neutrophils',
-                  'racoon-covid-19-lymphocytes',
-                  'racoon-covid-19-biochemical-total-protein',
-                  'racoon-covid-19-biochemical-albumin',
-                  'racoon-covid-19-biochemical-globulin',
-                  'racoon-covid-19-biochemical-prealbumin',
-                  'racoon-covid-19-biochemical-urea',
-                  'racoon-covid-19-biochemical-total-bilirubin',
-                  'racoon-covid-19-biochemical-creatinine',
-                  'racoon-covid-19-biochemical-gfr',
-                  'racoon-covid-19-biochemical-glucose',
-                  'racoon-covid-19-biochemical-creatine-kinase-muscle-brain-isoform',
-                  'racoon-covid-19-biochemical-cholinesterase',
-                  'racoon-covid-19-biochemical-cystatin-c',
-                  'racoon-covid-19-biochemical-lactate',
-                  'racoon-covid-19-biochemical-lactate-dehydrogenase',
-                  'racoon-covid-19-biochemical-alpha-hydroxybutyric-dehydrogenase',
-                  'racoon-covid-19-biochemical-low-density-lipoprotein',
-                  'racoon-covid-19-biochemical-gamma-gt',
-                  'racoon-covid-19-biochemical-troponin-t2',
-                  'racoon-covid-19-biochemical-troponin-i',
-                  'racoon-covid-19-biochemical-nt-pro-bnp',
-                  'racoon-covid-19-biochemical-aspartate-aminotransferase',
-                  'racoon-covid-19-biochemical-alanine-aminotransferase',
-                  'racoon-covid-19-infection-related-indices-serum-ferritin',
-                  'racoon-covid-19-infection-related-indices-high-sensitivity-c-reactive-protein',
-                  'racoon-covid-19-infection-related-indices-interleukin-six',
-                  'racoon-covid-19-infection-related-indices-procalcitonin',
-                  'racoon-covid-19-infection-related-indices-erythrocyte-sedimentation-rate',
-                  'racoon-covid-19-coagulation-function-d-dimer',
-                  'racoon-covid-19-coagulation-function-activated-partial-thromboplastin-time',
-                  'racoon-covid-19-coagulation-function-fibrinogen',
-                  'racoon-covid-19-coagulation-function-antithrombin-iii',
-                  'racoon-covid-19-coagulation-function-inr']
-                   
+# if a labels dict is given, it is filled with all labels of the case like get_covid_assessment_labels
+def get_covid_assessment(case, args, labels=None):
+    if isinstance(case, CaseRecord):
+        return case.assessment(labels)
+    label_schema = load_label_schema(getattr(args, 'schema', None))
     covid_assessment = {}
-
-    # fails for unknown reasons for some sites
-    lastname = ''
-    try:
-        lastname = case[0].attrib['LastName']
-    except:
-        print(f"Error getting lastname for case {case.attrib['CaseID']}, trying to continue without")
-        pass
-    
-    # if building the case_string fails use a random uuid
-    try:
-        case_string = case.attrib['CaseID'] + lastname + case[0].attrib['PatientID'] + case[0].attrib['InstitutionName']
-        hash_string = encrypt(case_string)
-    except:
-        print(f"Error building case_string for case {case.attrib['CaseID']}, using random UUID")
-        hash_string = str(uuid.uuid4())
-    covid_assessment["ID"] = hash_string
+    covid_assessment["ID"] = get_case_id(case)
 
     question_pairs = [('Label', 'QuestionType'), ('Question', 'Type')]
     for question in case.iter('Question'):
@@ -272,7 +1375,14 @@ def get_covid_assessment(case, args):
                     question_type = question.attrib[pair[1]]
                     new_value = question.attrib['Answer']
 
-                    if question_type in label_list:
+                    if labels is not None:
+                        # keep old value if new value is invalid, as in get_covid_assessment_labels
+                        if question_type in labels and len(new_value) == 0:
+                            labels[question_type] = [question.attrib[pair[0]], labels[question_type][1]]
+                        else:
+                            labels[question_type] = [question.attrib[pair[0]], new_value]
+
+                    if question_type in label_schema:
                         # check if question type already exists in list, possibly from other question/label 
                         if question_type in covid_assessment.keys():
                             # check if existing value and new value are not the same
@@ -284,12 +1394,47 @@ def get_covid_assessment(case, args):
                                     new_value = old_value                             
                         covid_assessment[question_type] = new_value
                 else:
-                    print(f"No type attribute in question {question.attrib[pair[0]]}")
+                    report_event('missing_type', f"No type attribute in question {question.attrib[pair[0]]}")
         
     return covid_assessment
 
+# pseudonymised case ID built from the case and patient attributes
+def get_case_id(case, report_errors=True):
+    return case_id_from_attributes(case.attrib, case[0].attrib if len(case) else None, report_errors)
+
+# pseudonymised case ID built from the attributes of the case and of its first child, the patient
+def case_id_from_attributes(case_attrib, patient_attrib, report_errors=True):
+    # fails for unknown reasons for some sites
+    lastname = ''
+    try:
+        lastname = patient_attrib['LastName']
+    except:
+        if report_errors:
+            report_event('missing_lastname', f"Error getting lastname for case {case_attrib['CaseID']}, trying to continue without")
+        pass
+    
+    # if building the case_string fails use a random uuid
+    try:
+        case_string = case_attrib['CaseID'] + lastname + patient_attrib['PatientID'] + patient_attrib['InstitutionName']
+        hash_string = encrypt(case_string)
+    except:
+        if report_errors:
+            report_event('hash_fallback', f"Error building case_string for case {case_attrib['CaseID']}, using random UUID")
+        hash_string = str(uuid.uuid4())
+    return hash_string
+
+# fingerprint of the raw XML of a case, the salt should change whenever the extraction
+# itself changes (e.g. a different label schema)
+def case_fingerprint(case_xml, salt=''):
+    hash_object = hashlib.blake2b(salt.encode(), digest_size=16)
+    hash_object.update(case_xml)
+    return hash_object.hexdigest()
+
 # parse table of all possible assessments, including internal type, human readable text and example string
 def get_covid_assessment_labels(case, args):                    
+    if isinstance(case, CaseRecord):
+        case.assessment() # raises the error of a case that could not be extracted
+        return case.labels
     covid_assessment = {}
     question_pairs = [('Label', 'QuestionType'), ('Question', 'Type')]
     for question in case.iter('Question'):
@@ -310,7 +1455,7 @@ def get_covid_assessment_labels(case, args):
                                 new_value = old_value                                                             
                     covid_assessment[question_type] = [question.attrib[pair[0]], new_value]
                 else:
-                    print(f"No type attribute in question {question.attrib[pair[0]]}")
+                    report_event('missing_type', f"No type attribute in question {question.attrib[pair[0]]}")
         
     return covid_assessment
 
@@ -329,22 +1474,335 @@ def getAllCases(root) -> list:
                 cases.append(case)
     return cases
 
-# program entry point
-if __name__ == "__main__":
-    # define arguments
+# incrementally parse cases, yielding each Trial/TrialArm/Case as soon as it is closed;
+# elements are released once they are no longer needed, so memory is bounded by the largest case
+def iterCases(xml_file):
+    path = []       # stack of currently open elements
+    case_depth = 0  # number of open Case elements
+    with open_input(xml_file) as file:
+        for event, elem in et.iterparse(file, events=('start', 'end')):
+            if event == 'start':
+                path.append(elem)
+                if elem.tag == 'Case':
+                    case_depth += 1
+                continue
+
+            path.pop()
+            if elem.tag == 'Case':
+                case_depth -= 1
+                tags = [parent.tag for parent in path]
+                if 'Trial' in tags and 'TrialArm' in tags[tags.index('Trial'):]:
+                    yield elem
+
+            # keep elements of unfinished cases, everything else is dropped from its parent once closed
+            if case_depth == 0:
+                elem.clear()
+                if path:
+                    path[-1].remove(elem)
+
+# parse the raw XML of a single case split off the input by iterCaseSlices
+def parse_case(case_xml, args, collect_labels=False):
+    if args.parser == 'lxml':
+        from lxml import etree
+        return etree.fromstring(case_xml)
+    if args.parser == 'expat':
+        return CaseRecordParser(args, collect_labels).parse_case(case_xml)
+    return et.fromstring(case_xml)
+
+# tags of the raw XML that are relevant to find the cases: comments, CDATA sections, processing
+# instructions and the document type are skipped as they may contain anything, and the start and
+# end tags of Trial, TrialArm and Case elements give the position of the cases
+XML_MARKUP = re.compile(rb'<(?:(!--)|(!\[CDATA\[)|(\?)|(!DOCTYPE)|(/?)(Trial|TrialArm|Case)(?=[\s/>]))')
+XML_TAG_END = re.compile(rb'(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+XML_DOCTYPE_END = re.compile(rb'[^\[>]*(?:\[.*?\])?\s*>', re.DOTALL)
+XML_ENCODING = re.compile(rb'^<\?xml[^>]*?encoding\s*=\s*["\']([A-Za-z0-9._-]+)')
+
+# split the raw XML of each Trial/TrialArm/Case off the input without parsing the document, the
+# tags are found by scanning the bytes, which is many times faster than parsing; only the nesting
+# of the Trial, TrialArm and Case elements is checked, other errors show up when a case is parsed.
+# The cases are returned as UTF-8, inputs with other encodings that are not ASCII compatible
+# (e.g. UTF-16) are parsed with iterCases instead
+def iterCaseSlices(xml_file, chunk_size=1 << 22):
+    with open_input(xml_file) as file:
+        data = file.read(max(chunk_size, 1024))
+        encoding = 'utf-8'
+        match = XML_ENCODING.match(data.removeprefix(codecs.BOM_UTF8))
+        if match is not None:
+            encoding = codecs.lookup(match.group(1).decode('ascii')).name
+        if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)) or '<Case>'.encode(encoding, 'replace') != b'<Case>':
+            encoding = None
+        else:
+            yield from _split_cases(file, data, encoding, chunk_size)
+    if encoding is None:
+        for case in iterCases(xml_file):
+            yield et.tostring(case)
+
+def _split_cases(file, data, encoding, chunk_size):
+    buffer = data
+    base = 0       # offset of the buffer in the input
+    pos = 0        # position in the buffer up to which all tags have been handled
+    stack = []     # open Trial, TrialArm and Case elements with the input offset of their start tag
+    eof = False
+    while True:
+        incomplete = False
+        while True:
+            match = XML_MARKUP.search(buffer, pos)
+            if match is None:
+                break
+            start = match.start()
+            if match.group(1) or match.group(2) or match.group(3):
+                end = buffer.find(b'-->' if match.group(1) else b']]>' if match.group(2) else b'?>', match.end())
+                end = -1 if end < 0 else end + (2 if match.group(3) else 3)
+            elif match.group(4):
+                end_match = XML_DOCTYPE_END.match(buffer, match.end())
+                end = -1 if end_match is None else end_match.end()
+            elif match.group(5):
+                end = buffer.find(b'>', match.end())
+                end = -1 if end < 0 else end + 1
+            else:
+                end_match = XML_TAG_END.match(buffer, match.end())
+                end = -1 if end_match is None else end_match.end()
+            if end < 0:
+                incomplete = True
+                break
+            pos = end
+            tag = match.group(6)
+            if tag is None:
+                continue
+
+            tag = tag.decode('ascii')
+            if match.group(5):
+                if not stack or stack[-1][0] != tag:
+                    raise et.ParseError(f"mismatched tag </{tag}> at offset {base + start}")
+                _, case_start = stack.pop()
+            elif buffer[end - 2:end - 1] == b'/':
+                case_start = base + start
+            else:
+                stack.append((tag, base + start))
+                continue
+
+            # the case is complete, it is returned if it is part of a Trial/TrialArm like in iterCases
+            tags = [parent for parent, _ in stack]
+            if tag == 'Case' and 'Trial' in tags and 'TrialArm' in tags[tags.index('Trial'):]:
+                case_xml = buffer[case_start - base:end]
+                yield case_xml if encoding == 'utf-8' else case_xml.decode(encoding).encode('utf-8')
+
+        if eof:
+            if incomplete or stack:
+                raise et.ParseError(f"unclosed {stack[-1][0] if stack else 'tag'} at end of input")
+            return
+
+        # keep the open cases and the end of the buffer, which may hold the beginning of a tag
+        keep = pos if incomplete else max(pos, len(buffer) - 16)
+        cases = [offset - base for tag, offset in stack if tag == 'Case']
+        if cases:
+            keep = min(keep, cases[0])
+        data = file.read(chunk_size)
+        eof = not data
+        buffer = buffer[keep:] + data
+        base += keep
+        pos -= keep
+        if pos < 0:
+            pos = 0
+
+# a case extracted by the expat parser without building any elements: the case attributes,
+# its pseudonymised ID, the values of the labels of the schema and, if requested, all labels of
+# the case for the label catalog; errors are kept until the assessment is requested, as they
+# must not be raised in the callbacks of the parser
+class CaseRecord:
+    def __init__(self, attrib, collect_labels=False):
+        self.attrib = attrib
+        self.patient = None # attributes of the first child
+        self.id = None
+        self.values = {}
+        self.labels = {} if collect_labels else None
+        self.error = None
+
+    # the assessment as returned by get_covid_assessment, the labels are added to the given dict
+    def assessment(self, labels=None):
+        if self.error is not None:
+            raise self.error
+        if labels is not None:
+            labels.update(self.labels)
+        return {'ID': self.id, **self.values}
+
+# expat parser building a CaseRecord per Trial/TrialArm/Case of an input file, or of the raw XML
+# of a single case; the answers are handled as in get_covid_assessment while parsing. Within a
+# case the handlers are switched to ones that only count the depth instead of tracking all tags
+class CaseRecordParser:
+    question_pairs = [('Label', 'QuestionType'), ('Question', 'Type')]
+
+    def __init__(self, args=None, collect_labels=False):
+        self.label_schema = load_label_schema(getattr(args, 'schema', None))
+        self.verbose = getattr(args, 'verbose', False)
+        self.collect_labels = collect_labels
+        self.parser = None
+        self.tags = []       # stack of the open tags outside of cases
+        self.completed = []  # cases completed since the caller took them
+        self.case = None
+        self.depth = 0       # number of open elements within the current case
+
+    # parse the raw XML of a single case, as split off the input by iterCaseSlices; the case
+    # ends with the input, so no end handler is needed
+    def parse_case(self, case_xml):
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self.start_single_case
+        self.parser.Parse(case_xml, True)
+        return self.finish_case()
+
+    # all Trial/TrialArm/Case records of an input file
+    def iter_cases(self, xml_file, chunk_size=1 << 20):
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        with open_input(xml_file) as file:
+            while True:
+                data = file.read(chunk_size)
+                self.parser.Parse(data, not data)
+                yield from self.completed
+                self.completed.clear()
+                if not data:
+                    break
+
+    def start_single_case(self, tag, attrib):
+        self.case = CaseRecord(attrib, self.collect_labels)
+        self.parser.StartElementHandler = self.case_element
+
+    def start_element(self, tag, attrib):
+        tags = self.tags
+        tags.append(tag)
+        if tag == 'Case' and 'Trial' in tags and 'TrialArm' in tags[tags.index('Trial'):-1]:
+            self.case = CaseRecord(attrib, self.collect_labels)
+            self.parser.StartElementHandler = self.case_element
+            self.parser.EndElementHandler = self.case_end_element
+
+    def end_element(self, tag):
+        self.tags.pop()
+
+    def case_element(self, tag, attrib):
+        self.depth += 1
+        case = self.case
+        if case.patient is None:
+            # the first child holds the patient attributes
+            case.patient = attrib
+        if tag == 'Question' and case.error is None:
+            self.add_question(case, attrib)
+
+    def case_end_element(self, tag):
+        if self.depth > 0:
+            self.depth -= 1
+            return
+        self.completed.append(self.finish_case())
+        self.tags.pop()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+
+    def add_question(self, case, attrib):
+        for name, type_name in self.question_pairs:
+            if name in attrib:
+                if type_name in attrib:
+                    question_type = attrib[type_name]
+                    new_value = attrib.get('Answer')
+                    if new_value is None:
+                        case.error = KeyError('Answer')
+                        return
+
+                    labels = case.labels
+                    if labels is not None:
+                        # keep old value if new value is invalid, as in get_covid_assessment_labels
+                        if question_type in labels and len(new_value) == 0:
+                            labels[question_type] = [attrib[name], labels[question_type][1]]
+                        else:
+                            labels[question_type] = [attrib[name], new_value]
+
+                    if question_type in self.label_schema:
+                        old_value = case.values.get(question_type)
+                        if old_value is not None and old_value != new_value and len(new_value) == 0:
+                            # keep old value if new value is invalid
+                            if self.verbose:
+                                print(f"{question_type} already in list with value: {old_value} vs. {new_value}, using {old_value}")
+                            new_value = old_value
+                        case.values[question_type] = new_value
+                else:
+                    report_event('missing_type', f"No type attribute in question {attrib[name]}")
+
+    # the ID is built once the case is complete, like the rows of the other parsers
+    def finish_case(self):
+        case = self.case
+        try:
+            case.id = case_id_from_attributes(case.attrib, case.patient)
+        except Exception as e:
+            case.error = e
+        self.case = None
+        return case
+
+# incrementally parse cases with expat callbacks instead of building the whole element tree;
+# no elements are built at all, the row of each Trial/TrialArm/Case is extracted while parsing
+# and returned as a CaseRecord
+def iterCasesExpat(xml_file, args=None, collect_labels=False):
+    return CaseRecordParser(args, collect_labels).iter_cases(xml_file)
+
+# incrementally parse cases with lxml, if it is installed, like iterCases
+def iterCasesLxml(xml_file):
+    from lxml import etree
+    with open_input(xml_file) as file:
+        for _, case in etree.iterparse(file, events=('end',), tag='Case'):
+            tags = [parent.tag for parent in case.iterancestors()][::-1]
+            if 'Trial' in tags and 'TrialArm' in tags[tags.index('Trial'):]:
+                yield case
+            if 'Case' not in tags:
+                # release the case and everything before it
+                case.clear()
+                while case.getprevious() is not None:
+                    del case.getparent()[0]
+
+# define arguments
+def get_arg_parser():
     parser = argparse.ArgumentParser(description="Anonymize and export parameters for RACOON Ruleout from Mint XML dump")
-    parser.add_argument("-i", "--input", help="Input XML file")
-    parser.add_argument("-o", "--output", help="Output Excel file")    
+    parser.add_argument("-i", "--input", help="Input XML file (plain, .gz, .zst, .zstd or .zip), or a directory or glob pattern of several XML files that are merged into one output")
+    parser.add_argument("-o", "--output", help="Output file, the format is chosen by the file extension (xlsx, csv, parquet or arrow)")
+    parser.add_argument("-f", "--format", help="Output format, overrides the file extension", choices=OUTPUT_FORMATS.keys())
     parser.add_argument("-v", "--verbose", help="Verbose log output", action="store_true")
+    parser.add_argument("-s", "--stream", help="Parse the input incrementally instead of loading the whole XML tree into memory", action="store_true")
+    parser.add_argument("-p", "--parser", help="XML parser, expat and lxml always stream and only keep the attributes required for the export (default: etree)", choices=['etree', 'expat', 'lxml'], default='etree')
+    parser.add_argument("--schema", help="Label schema file mapping the exported labels to their data types (default: ruleout_labels.json)")
+    parser.add_argument("--incremental", help="Case index file (SQLite) used to only re-parse new or changed cases of a previous export")
+    parser.add_argument("--chunk-size", help="Write the parsed cases in shards of this many cases next to the output file, so an interrupted export can be resumed", type=int)
+    parser.add_argument("--resume", help="Resume an interrupted export with the shards of the previous run", action="store_true")
+    parser.add_argument("--catalog", help="Write a catalog of all labels with their question text and value statistics to this file (xlsx or csv)")
+    parser.add_argument("--catalog-top-k", help="Number of most frequent values listed per label in the catalog", type=int, default=10)
+    parser.add_argument("--filters", help="JSON file with case filter rules (min_age, max_age, require, min_labels), command line options take precedence")
+    parser.add_argument("--min-age", help="Exclude cases younger than this age, \"none\" turns off a limit of the rule file", type=age_limit)
+    parser.add_argument("--max-age", help="Exclude cases with at least this age (default: 100), \"none\" turns off the limit", type=age_limit)
+    parser.add_argument("--require", help="Exclude cases without a value for this label, can be given several times", action="append")
+    parser.add_argument("--min-labels", help="Exclude cases with fewer non-empty labels", type=int)
+    parser.add_argument("--report", help="Write a JSON report with timings, memory usage and counters of the run to this file")
+    parser.add_argument("--max-messages", help="Maximum number of messages printed per type of error", type=int, default=10)
+    parser.add_argument("--watch", help="Keep running and export every new input file in this directory to the output directory (default: the watched directory)")
+    parser.add_argument("--watch-interval", help="Seconds between two checks of the watched directory", type=float, default=2.0)
+    parser.add_argument("-w", "--workers", help="Number of worker processes used to parse and anonymize cases, in batch mode the number of files parsed concurrently", type=int, default=1)
+    return parser
+
+# program entry point
+if __name__ == "__main__":
+    multiprocessing.freeze_support() # required for worker processes in the pyinstaller binary
 
+    parser = get_arg_parser()
     args = parser.parse_args()
 
+    if args.watch is not None:
+        if args.input is not None or args.incremental or args.catalog or args.report or args.resume:
+            parser.error("--watch cannot be combined with --input, --incremental, --catalog, --report or --resume")
+        watch(args)
+        raise SystemExit
+
     if args.input is None:
         import tkinter
         from tkinter import filedialog as fd
 
         filetypes = (
                 ('XML files', '*.xml'),
+                ('Compressed XML files', '*.xml.gz *.xml.zst *.xml.zstd *.zip'),
                 ('All files', '*.*')
             )
 
@@ -358,9 +1816,23 @@ if __name__ == "__main__":
             )
         root.destroy()
 
+        # a cancelled dialog returns an empty name, which must not be taken for the current directory
+        if not filename:
+            raise SystemExit("No input file selected")
         args.input = Path(filename)
 
+    xml_files = resolve_inputs(args.input)
+    if args.incremental and len(xml_files) > 1:
+        parser.error("--incremental requires a single input file")
+    if args.chunk_size and (args.incremental or len(xml_files) > 1):
+        parser.error("--chunk-size requires a single input file and cannot be combined with --incremental")
+    if args.resume and not args.chunk_size:
+        parser.error("--resume requires --chunk-size")
+
     if args.output is None:
-        args.output = Path.joinpath(Path(args.input).parent, Path(args.input).stem + ".xlsx")
+        if len(xml_files) > 1:
+            args.output = Path.joinpath(xml_files[0].parent, "ruleout_export.xlsx")
+        else:
+            args.output = Path.joinpath(Path(args.input).parent, input_stem(args.input) + ".xlsx")
 
-    main(args)
\ No newline at end of file
+    main(args)
@@ -0,0 +1,96 @@
+from pathlib import Path
+from xml.sax.saxutils import quoteattr
+import argparse
+import random
+import json
+
+# generate a synthetic Mint RACOON XML export that contains no patient data, used for benchmarks;
+# the cases use the real racoon-covid-19-* question types from the label schema
+def generate(out_file, num_cases, args):
+    rng = random.Random(args.seed)
+    with open(args.schema or Path(__file__).parent / 'ruleout_labels.json', encoding='utf-8') as file:
+        label_schema = json.load(file)
+    labels = list(label_schema.items())
+    noise_labels = [f"racoon-covid-19-synthetic-unused-{i}" for i in range(args.noise_labels)]
+
+    num_trial_arms = args.trials * args.arms
+    with open(out_file, 'w', encoding='utf-8', buffering=1 << 20) as file:
+        file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        file.write('<MintExport Version="synthetic">\n')
+        case_id = 0
+        for trial in range(args.trials):
+            file.write(f'  <Trial Name="RACOON-{trial}">\n')
+            for arm in range(args.arms):
+                file.write(f'    <TrialArm Name="Arm-{arm}">\n')
+                # distribute the cases evenly over all trial arms
+                arm_index = trial * args.arms + arm
+                num_arm_cases = num_cases // num_trial_arms + (1 if arm_index < num_cases % num_trial_arms else 0)
+                for _ in range(num_arm_cases):
+                    case_id += 1
+                    write_case(file, case_id, labels, noise_labels, rng, args)
+                file.write('    </TrialArm>\n')
+            file.write('  </Trial>\n')
+        file.write('</MintExport>\n')
+
+# write a single case with its patient attributes and questions
+def write_case(file, case_id, labels, noise_labels, rng, args):
+    file.write(f'      <Case CaseID="{case_id}" Created="2021-01-01T00:00:00">\n')
+
+    # the lastname is missing for some sites
+    lastname = '' if rng.random() < 0.02 else f' LastName="Synthetic{case_id}"'
+    file.write(f'        <Patient{lastname} PatientID="SYN{case_id:08d}" InstitutionName="Site-{case_id % args.sites}" BirthDate="1950-01-01"/>\n')
+
+    file.write('        <Report Status="finished">\n')
+    file.write('          <Questions>\n')
+    for label, dtype in labels:
+        if rng.random() > args.fill_rate:
+            continue
+        write_question(file, label, random_answer(label, dtype, rng), rng)
+
+        # some labels are answered twice, sometimes with an empty second answer
+        if rng.random() < 0.05:
+            write_question(file, label, '' if rng.random() < 0.5 else random_answer(label, dtype, rng), rng)
+    for label in noise_labels:
+        if rng.random() < args.fill_rate:
+            write_question(file, label, str(rng.randint(0, 10)), rng)
+    file.write('          </Questions>\n')
+    file.write('        </Report>\n')
+    file.write('      </Case>\n')
+
+# questions use both the Label/QuestionType and the Question/Type form
+def write_question(file, label, answer, rng):
+    text = quoteattr(label.replace('racoon-covid-19-', '').replace('-', ' '))
+    if rng.random() < 0.5:
+        file.write(f'            <Question Label={text} QuestionType="{label}" Answer={quoteattr(answer)}/>\n')
+    else:
+        file.write(f'            <Question Question={text} Type="{label}" Answer={quoteattr(answer)}/>\n')
+
+def random_answer(label, dtype, rng):
+    if dtype == 'int':
+        if label.endswith('age2'):
+            return str(rng.randint(18, 104))
+        return str(rng.randint(0, 25))
+    if dtype == 'float':
+        value = f"{rng.lognormvariate(2, 1):.2f}"
+        return value.replace('.', ',') if rng.random() < 0.1 else value
+    if dtype == 'bool':
+        return rng.choice(['true', 'false'])
+    return rng.choice(['yes', 'no', 'unknown', 'not assessable', 'mild', 'moderate', 'severe'])
+
+# program entry point
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Mint RACOON XML export for benchmarks")
+    parser.add_argument("-o", "--output", help="Output XML file", required=True)
+    parser.add_argument("-n", "--cases", help="Number of cases", type=int, default=1000)
+    parser.add_argument("--trials", help="Number of trials", type=int, default=1)
+    parser.add_argument("--arms", help="Number of trial arms per trial", type=int, default=2)
+    parser.add_argument("--sites", help="Number of distinct institutions", type=int, default=10)
+    parser.add_argument("--fill-rate", help="Probability of a label being answered", type=float, default=0.6)
+    parser.add_argument("--noise-labels", help="Number of additional question types that are not exported", type=int, default=20)
+    parser.add_argument("--schema", help="Label schema file (default: ruleout_labels.json)")
+    parser.add_argument("--seed", help="Random seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    print(f"Writing {args.cases} synthetic cases to {args.output}")
+    generate(args.output, args.cases, args)
@@ -0,0 +1,91 @@
+from pathlib import Path
+import argparse
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import ruleout_export
+import synthetic_mint
+
+# synthetic export shared by all tests, small enough to be generated for every test run
+@pytest.fixture(scope='module')
+def xml_file(tmp_path_factory):
+    xml_file = tmp_path_factory.mktemp('input') / 'synthetic.xml'
+    generator_args = argparse.Namespace(seed=1, schema=None, trials=1, arms=2, sites=10, fill_rate=0.6, noise_labels=20)
+    synthetic_mint.generate(xml_file, 300, generator_args)
+    return xml_file
+
+# run the export like the command line does, returns the bytes of the output and the label catalog
+def export(xml_file, out_dir, options):
+    out_file = out_dir / 'out.csv'
+    catalog_file = out_dir / 'catalog.csv'
+    args = ruleout_export.get_arg_parser().parse_args(['-i', str(xml_file), '-o', str(out_file), '--catalog', str(catalog_file)] + options)
+    ruleout_export.main(args)
+    return out_file.read_bytes(), catalog_file.read_bytes()
+
+# the expat parser extracts the rows without building elements, its output must not differ from etree
+@pytest.mark.parametrize('options', [['-p', 'expat'], ['-p', 'expat', '-w', '2'], ['-s'], ['-w', '2']])
+def test_output_matches_etree(xml_file, tmp_path, options):
+    (tmp_path / 'etree').mkdir()
+    (tmp_path / 'other').mkdir()
+    expected = export(xml_file, tmp_path / 'etree', [])
+    assert export(xml_file, tmp_path / 'other', options) == expected
+
+# incremental exports must match a full export, also if a case occurs twice with identical XML
+def test_incremental_export_with_repeated_case(xml_file, tmp_path):
+    data = xml_file.read_bytes()
+    start = data.index(b'<Case ')
+    end = data.index(b'</Case>', start) + len(b'</Case>')
+    arm_end = data.index(b'</TrialArm>')
+    repeated_file = tmp_path / 'repeated.xml'
+    repeated_file.write_bytes(data[:arm_end] + data[start:end] + b'\n' + data[arm_end:])
+
+    (tmp_path / 'full').mkdir()
+    (tmp_path / 'incremental').mkdir()
+    expected = export(repeated_file, tmp_path / 'full', [])
+    index_file = str(tmp_path / 'index.db')
+    for _ in range(2): # the first run fills the index, the second one reuses it
+        assert export(repeated_file, tmp_path / 'incremental', ['--incremental', index_file]) == expected
+    assert export(xml_file, tmp_path / 'incremental', ['--incremental', index_file]) == export(xml_file, tmp_path / 'full', [])
+
+# an export interrupted while a shard is committed must resume to the same output and catalog
+def test_resume_chunked_export_after_crash(xml_file, tmp_path, monkeypatch, capsys):
+    (tmp_path / 'full').mkdir()
+    (tmp_path / 'chunked').mkdir()
+    expected = export(xml_file, tmp_path / 'full', [])
+
+    # crash after the shard and the catalog of the second chunk have been written, before the manifest
+    replace = ruleout_export.os.replace
+    num_manifests = 0
+    def crashing_replace(source, target):
+        nonlocal num_manifests
+        if Path(target).name == 'manifest.json':
+            num_manifests += 1
+            if num_manifests == 2:
+                raise OSError("simulated crash")
+        replace(source, target)
+    monkeypatch.setattr(ruleout_export.os, 'replace', crashing_replace)
+    with pytest.raises(OSError, match="simulated crash"):
+        export(xml_file, tmp_path / 'chunked', ['--chunk-size', '100'])
+    monkeypatch.setattr(ruleout_export.os, 'replace', replace)
+    capsys.readouterr()
+
+    assert export(xml_file, tmp_path / 'chunked', ['--chunk-size', '100', '--resume']) == expected
+    assert "Resuming export after 100 cases" in capsys.readouterr().out
+
+# values that python and pandas read differently, e.g. non-ASCII digits and long numbers
+COERCE_VALUES = ['12', ' 12 ', '12,5', '-0', '.5', '5.', '+5', '1e3', '1E+5', '1e400', 'inf', '-Infinity', 'nan',
+                 '9223372036854775807', '-9223372036854775808', '9007199254740993', '123456789012345678901234567890',
+                 '٣', '１２', '１２.５', '۱۲', '९', '²', '1_000', '0x10', '1 000', '1.2.3', '12abc', 'e5', '+', '',
+                 ' 12 ', '　12', '\x1c12', 'true', ' Ja ', 'NEIN', '0', '1.0', 'ＴＲＵＥ']
+
+# the row based writers (csv, xlsx) must convert values like the column based ones (parquet, arrow)
+@pytest.mark.parametrize('dtype', ['int', 'float', 'bool'])
+def test_coerce_value_matches_coerce_columns(dtype):
+    pd = pytest.importorskip('pandas')
+    df = pd.DataFrame({'label': COERCE_VALUES})
+    ruleout_export.coerce_columns(df, {'label': dtype})
+    columns = [None if pd.isna(value) else value for value in df['label']]
+    values = [ruleout_export.coerce_value(value, dtype) for value in COERCE_VALUES]
+    assert values == columns